@@ -1,10 +1,35 @@
 import numpy as np
-from scipy.interpolate import interp1d, RegularGridInterpolator
+from scipy.interpolate import RegularGridInterpolator
 from scipy.integrate import cumtrapz
 
-from .model import model_base
+from .model import blackbody_model
 
-class kilonova(model_base):
+def _time_grid(tmax):
+    '''
+    Compute the (log-spaced) time grid used to solve for the lightcurve, along
+    with the parameter-independent factor of the radioactive heating rate.
+
+    Parameters
+    ----------
+    tmax : float
+        Last time in the grid (days)
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        Times in days, times in seconds, and the heating rate factor
+    '''
+    d2s = 24.0 * 3600.0
+    tmin = 1.0e-6
+    n = 1000
+    tdays = np.logspace(np.log10(tmin), np.log10(tmax), n)
+    t = tdays * d2s
+    t0 = 1.3 # s
+    sigma = 0.11 # s
+    heating = (0.5 - np.arctan((t - t0) / sigma) / np.pi)**1.3
+    return tdays, t, heating
+
+class kilonova(blackbody_model):
     def __init__(self):
         name = "kilonova"
         param_names = ["mej",
@@ -12,7 +37,7 @@ class kilonova(model_base):
                        "kappa",
                        "sigma"]
         bands = ["g", "r", "i", "z", "y", "J", "H", "K"]
-        model_base.__init__(self, name, param_names, bands)
+        blackbody_model.__init__(self, name, param_names, bands)
         
         _v = np.array([0.1, 0.2, 0.3])
         _m = np.array([1.0e-3, 5.0e-3, 1.0e-2, 5.0e-2])
@@ -26,21 +51,10 @@ class kilonova(model_base):
         self.fb = RegularGridInterpolator((_m, _v), _b, bounds_error=False, fill_value=None)
         self.fd = RegularGridInterpolator((_m, _v), _d, bounds_error=False, fill_value=None)
 
-        self.lmbda_dict = { # dictionary of wavelengths corresponding to bands
-                "u":354.3,
-                "g":477.56,
-                "r":612.95,
-                "i":748.46,
-                "z":865.78,
-                "y":960.31,
-                "J":1235.0,
-                "H":1662.0,
-                "K":2159.0
-        }
-
-        self.tdays = None
-        self.R_photo = None
-        self.T_photo = None
+        self.t = None
+        self.heating = None
+        self.grid_tmax = None # tmax used to compute the cached time grid
+        self.lc_params = None # per-lightcurve parameters, as column vectors (see _photosphere)
     
     def set_params(self, params, t_bounds):
         """
@@ -50,83 +64,65 @@ class kilonova(model_base):
         Parameters
         ----------
         params : dict
-            Dictionary mapping parameter names to their values
+            Dictionary mapping parameter names to their values (either floats
+            or 1d arrays, with one lightcurve computed per array element)
         t_bounds : list
             [upper bound, lower bound] pair for time values
         """
+        self.scalar = np.ndim(params["mej"]) == 0
         self.sigma = params["sigma"]
-        ### conversion factors and physical constants
+
+        ### the time grid and the parameter-independent part of the heating
+        ### rate only depend on tmax, so they are only recomputed when it changes
+        if t_bounds[1] != self.grid_tmax:
+            self.tdays, self.t, self.heating = _time_grid(t_bounds[1])
+            self.grid_tmax = t_bounds[1]
+
+        ### parameters are column vectors, so each row is one lightcurve. the
+        ### photosphere is computed from them when the model is evaluated, a
+        ### chunk of rows at a time (see _photosphere)
+        self.n_rows = max(np.size(params[name]) for name in ["mej", "vej", "kappa"])
+        mej = np.broadcast_to(np.reshape(params["mej"], (-1, 1)), (self.n_rows, 1))
+        vej = np.broadcast_to(np.reshape(params["vej"], (-1, 1)), (self.n_rows, 1))
+        coords = np.hstack([mej, vej])
+        self.lc_params = {"mej":mej, "vej":vej, "kappa":np.broadcast_to(np.reshape(params["kappa"], (-1, 1)), (self.n_rows, 1)),
+                          "a":self.fa(coords).reshape((-1, 1)),
+                          "b":self.fb(coords).reshape((-1, 1)),
+                          "d":self.fd(coords).reshape((-1, 1))}
+
+    def _photosphere(self, rows):
+        ### photosphere radius and temperature on the time grid, for the lightcurves selected by rows
+        ### (a slice or index array), with one row per lightcurve and one column per grid time. there's
+        ### a single component, so each is returned as a list of one array (see blackbody_model._photosphere)
         Msun = 1.988409870698051e33 # g
         c = 2.99792458e10 # cm/s
         sigmaSB = 5.67e-5 # erg cm^-2 s^-1 K^-4
-        d2s = 24.0 * 3600.0
-
-        ### initialize time arrays
-        tmin = 1.0e-6
-        tmax = t_bounds[1]
-        n = 1000
-        tdays = np.logspace(np.log10(tmin), np.log10(tmax), n)
-        self.tdays = tdays
-        t = tdays * d2s
+        tdays = self.tdays
+        t = self.t
 
         ### constants
-        t0 = 1.3 # s
-        sigma = 0.11 # s
         beta = 13.7
         Tc = 4000.0 # K
 
-        ### compute photosphere radius and temperature
-        mej, vej, kappa = params["mej"], params["vej"], params["kappa"]
-        a = self.fa([mej, vej])[0]
-        b = self.fb([mej, vej])[0]
-        d = self.fd([mej, vej])[0]
-        vej *= c
+        mej, kappa, a, b, d = [self.lc_params[key][rows] for key in ["mej", "kappa", "a", "b", "d"]]
+        vej = self.lc_params["vej"][rows] * c
         td = np.sqrt(2.0 * kappa * (mej * Msun) / (beta * vej * c))
-        L_in = 4.0e18 * (mej * Msun) * (0.5 - np.arctan((t - t0) / sigma) / np.pi)**1.3
+        L_in = 4.0e18 * (mej * Msun) * self.heating
         e_th = 0.36 * (np.exp(-a * tdays) + np.log1p(2.0 * b * tdays**d) / (2.0 * b * tdays**d))
         L_in *= e_th
 
         integrand = L_in * t * np.exp((t / td)**2) / td
-        L_bol = np.empty(t.size)
-        L_bol[1:] = cumtrapz(integrand, t)
-        L_bol[0] = L_bol[1]
+        L_bol = np.empty(integrand.shape)
+        L_bol[:,1:] = cumtrapz(integrand, t, axis=1)
+        L_bol[:,0] = L_bol[:,1]
         L_bol *= 2.0 * np.exp(-(t / td)**2) / td
         
         _T_photo = (L_bol / (4.0 * np.pi * sigmaSB * vej**2 * t**2))**0.25
         _R_photo = (L_bol / (4.0 * np.pi * sigmaSB * Tc**4))**0.5
 
         mask = _T_photo < Tc
-        _T_photo[mask] = Tc
-        mask = np.logical_not(mask)
-        _R_photo[mask] = vej * t[mask]
-        self.R_photo = _R_photo
-        self.T_photo = _T_photo
-    
-    def evaluate(self, tvec_days, band):
-        """
-        Evaluate model at specific time values using the current parameters.
-
-        Parameters
-        ----------
-        tvec_days : np.ndarray
-            Time values
-        band : string
-            Band to evaluate
-        """
-        c = 2.99792458e10 # cm/s
-        h = 6.626e-27 # erg * s
-        kb = 1.38e-16 # erg/K
-        Mpc = 3.08e24 # cm
-        D = 1.0e-5 * Mpc # fiducial distance
-
-        lmbda = self.lmbda_dict[band] * 1.0e-7 # convert to cm
-        nu = c / lmbda
-
-        B_nu = (2.0 * h * nu**3 / c**2) / np.expm1(h * nu / (kb * self.T_photo))
-        F_nu = B_nu * np.pi * self.R_photo**2 / D**2
-        
-        mAB = -2.5 * np.log10(F_nu) - 48.6
-        mask = np.isfinite(mAB)
-        f = interp1d(self.tdays[mask], mAB[mask], fill_value="extrapolate")
-        return f(tvec_days), self.sigma
+        return [np.where(mask, _R_photo, vej * t)], [np.where(mask, Tc, _T_photo)]
 
+    def _row_bytes(self, n_bands):
+        ### approximate temporary memory per lightcurve used by _photosphere and _mAB (see model_base.row_chunks)
+        return 8 * self.tdays.size * (12 + 3 * n_bands)
@@ -1,12 +1,33 @@
 import numpy as np
-from scipy.interpolate import interp1d
 from joblib import load
 import os
 
-from .model import model_base
+from .model import model_base, interp_stencil
+from .surrogate import predict_row_bytes
+
+def _evaluate_gp(gp, inputs, lmbdas):
+    ### evaluate the GP for each wavelength in lmbdas (the last input column), giving one row per wavelength.
+    ### the surrogates can only be evaluated through their own evaluate() method, so unlike kn_interp_angle
+    ### the kernel is rebuilt for every wavelength, and the error is always computed as well as the mean
+    ### (so there's no saving when the model error is ignored)
+    mean = np.empty((len(lmbdas), inputs.shape[0]))
+    std = np.empty((len(lmbdas), inputs.shape[0]))
+    for i, lmbda in enumerate(lmbdas):
+        inputs[:,4] = lmbda
+        mean[i], std[i] = gp.evaluate(inputs)
+    return mean, std
 
 class kn_interp(model_base):
-    def __init__(self):
+    '''
+    Kilonova model interpolated from time-step surrogates
+
+    Parameters
+    ----------
+    step : int
+        Use every step-th time-step interpolator (default: the
+        EM_PE_KN_INTERP_STEP environment variable, or 4)
+    '''
+    def __init__(self, step=None):
         name = "kn_interp"
         param_names = ["mej_dyn", "vej_dyn", "mej_wind", "vej_wind"]
         bands = ["g", "r", "i", "z", "y", "J", "H", "K"]
@@ -18,23 +39,22 @@ class kn_interp(model_base):
             interp_loc += "/"
         full_times = np.loadtxt(interp_loc + "times.dat")
 
-        ind_use = np.arange(191) % 4 == 0 # use every 4th interpolator
+        ### use every n-th interpolator, where n defaults to the EM_PE_KN_INTERP_STEP environment variable (or 4)
+        if step is None:
+            step = int(os.environ.get("EM_PE_KN_INTERP_STEP", 4))
+        ind_use = np.arange(full_times.size) % step == 0
     
-        interpolator_suffixes = ["%03d" % i for i in range(191)]
-
         # force it to always use first and last interpolators
         ind_use[0] = True
         ind_use[-1] = True
 
         self.t_interp = full_times[ind_use]
 
-        self.interpolators = []
-
-        for i, suffix in enumerate(interpolator_suffixes):
-            if not ind_use[i]:
-                continue
-            print("loading interpolator", suffix)
-            self.interpolators.append(load(interp_loc + "saved_models/time_" + suffix + ".joblib"))
+        ### rather than preload all the interpolators, just store their file names. only the ones needed
+        ### for the times the model is evaluated at are loaded (see set_obs_times and _time_steps)
+        self.interpolator_fnames = [interp_loc + "saved_models/time_" + "%03d" % i + ".joblib" for i in np.where(ind_use)[0]]
+        self.interpolators = {} # loaded interpolators, by index into self.t_interp
+        self.time_steps = {} # cached interpolators used for each band (see _time_steps)
         
         self.lmbda_dict = { # dictionary of wavelengths corresponding to bands
                 "u":354.3,
@@ -50,6 +70,28 @@ class kn_interp(model_base):
 
         self.params_array = None
 
+    def set_obs_times(self, obs_times):
+        model_base.set_obs_times(self, obs_times)
+        ### load the interpolators needed for the observation times now, rather than on the first evaluation
+        for band, tvec_days in obs_times.items():
+            self._load(self._time_steps(tvec_days, band)[0])
+
+    def _load(self, ind_list):
+        for i in ind_list:
+            if i not in self.interpolators:
+                self.interpolators[i] = load(self.interpolator_fnames[i])
+
+    def _time_steps(self, tvec_days, band):
+        ### find the interpolators needed to interpolate (or extrapolate) to the requested times, i.e. the ones
+        ### bracketing each time. these only depend on the times, so they're cached for each band
+        cached = self.time_steps.get(band)
+        if cached is not None and (cached[0] is tvec_days or np.array_equal(cached[0], tvec_days)):
+            return cached[1], cached[2]
+        ind = np.clip(np.searchsorted(self.t_interp, tvec_days), 1, self.t_interp.size - 1)
+        ind_list = np.unique(np.concatenate([ind - 1, ind]))
+        self.time_steps[band] = (np.copy(tvec_days), ind_list, self.t_interp[ind_list])
+        return ind_list, self.t_interp[ind_list]
+
     def set_params(self, params, t_bounds):
         if isinstance(params["mej_dyn"], float):
             self.params_array = np.empty((1, 5))
@@ -61,24 +103,45 @@ class kn_interp(model_base):
         self.params_array[:,3] = params["vej_wind"]
 
     def evaluate(self, tvec_days, band):
-        mags_out = np.empty((self.params_array.shape[0], tvec_days.size))
-        mags_err_out = np.empty((self.params_array.shape[0], tvec_days.size))
-        self.params_array[:,4] = self.lmbda_dict[band]
+        return self.evaluate_bands({band:tvec_days})[band]
+
+    def evaluate_bands(self, obs_times):
+        bands = list(obs_times.keys())
+        lmbdas = np.array([self.lmbda_dict[band] for band in bands])
+
+        ### find out which interpolators are needed for any of the bands, and load any that haven't been yet
+        time_steps = {band:self._time_steps(obs_times[band], band) for band in bands}
+        ind_all = np.unique(np.concatenate([time_steps[band][0] for band in bands]))
+        self._load(ind_all)
 
-        mags_interp = np.empty((self.params_array.shape[0], self.t_interp.size))
-        mags_err_interp = np.empty((self.params_array.shape[0], self.t_interp.size))
+        ### the first index is the band, then one row per light curve and one column per interpolator in ind_all
+        mags_interp = np.empty((len(bands), self.params_array.shape[0], ind_all.size))
+        mags_err_interp = np.empty((len(bands), self.params_array.shape[0], ind_all.size))
         
-        for i, interpolator in enumerate(self.interpolators):
-            mags_interp[:,i], mags_err_interp[:,i] = interpolator.GP.evaluate(self.params_array)
-            mags_interp[:,i] *= interpolator.std
-            mags_interp[:,i] += interpolator.mean
-            mags_err_interp[:,i] *= interpolator.std
-
-        for i in range(self.params_array.shape[0]):
-            mags_interpolator = interp1d(self.t_interp, mags_interp[i], fill_value="extrapolate")
-            mags_err_interpolator = interp1d(self.t_interp, mags_err_interp[i], fill_value="extrapolate")
-            mags_out[i] = mags_interpolator(tvec_days)
-            mags_err_out[i] = mags_err_interpolator(tvec_days)
+        for i, ind in enumerate(ind_all):
+            interpolator = self.interpolators[ind]
+            ### evaluate the samples in chunks, to bound the memory used for the cross-kernel
+            for rows in self.row_chunks(self.params_array.shape[0], predict_row_bytes(interpolator.GP, len(bands))):
+                mags_interp[:,rows,i], mags_err_interp[:,rows,i] = _evaluate_gp(interpolator.GP, self.params_array[rows], lmbdas)
+                mags_interp[:,rows,i] *= interpolator.std
+                mags_interp[:,rows,i] += interpolator.mean
+                mags_err_interp[:,rows,i] *= interpolator.std
+
+        ret = {}
+        for i, band in enumerate(bands):
+            ind_list, t_interp = time_steps[band]
+            columns = np.searchsorted(ind_all, ind_list)
+            ret[band] = self._interpolate(mags_interp[i][:,columns], mags_err_interp[i][:,columns], t_interp, obs_times[band], band)
+        return ret
+
+    def _interpolate(self, mags_interp, mags_err_interp, t_interp, tvec_days, band):
+        stencil = self.get_stencil(t_interp, tvec_days, band)
+        if stencil is None:
+            ### not the registered observation times, so work out the interpolation for just this call
+            stencil = interp_stencil(t_interp, tvec_days)
+        ### interpolate (or extrapolate) all the light curves at once
+        mags_out = stencil(mags_interp)
+        mags_err_out = stencil(mags_err_interp)
         
         if self.params_array.shape[0] == 1:
             # if the model is being used in non-vectorized form, return 1d arrays
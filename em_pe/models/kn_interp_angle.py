@@ -1,17 +1,21 @@
 import numpy as np
-from scipy.interpolate import interp1d
 import os
 import sys
 import json
+import zipfile
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF, WhiteKernel, ConstantKernel as C
-from functools import lru_cache
-from scipy.linalg import cholesky, cho_solve
+from scipy.linalg import cholesky
 
-from .model import model_base
+from .model import model_base, interp_stencil
+from .surrogate import (get_surrogate_cache, gp_predict_columns, open_surrogate_archive, predict_row_bytes,
+                        design_fingerprint, shared_design_groups)
 
-#@lru_cache(maxsize=8)
-def _load_gp(fname_base):
+def _load_gp(fname_base, variance=True, archive=None):
+    if archive is not None:
+        name = os.path.relpath(fname_base, archive.directory)
+        if name in archive:
+            return _gp_from_archive(archive.get(name), fname_base, variance)
     kernel=None
     with open(fname_base+".json",'r') as f:
         my_json = json.load(f)
@@ -39,19 +43,98 @@ def _load_gp(fname_base):
     gp.alpha_ = my_alpha
     gp._y_train_std = float(my_json['y_train_std'])
     gp._y_train_mean = float(my_json['y_train_mean'])
+    gp.design_ = design_fingerprint(gp) # for grouping GPs that only differ by their weights (see shared_design_groups)
+    ### the Cholesky factor is only needed for the predictive variance
+    gp.L_ = _load_cholesky(gp, fname_base) if variance else None
     return gp
 
-def _model_predict(model, inputs):#, fix_log=False):
-    K = model.kernel_(model.X_train_)
-    K[np.diag_indices_from(K)] += model.alpha
-    model.L_ = cholesky(K, lower=True) # recalculating L matrix since this is what makes the pickled models bulky
-    model._K_inv = None # has to be set to None so the GP knows to re-calculate matrices used for uncertainty
-    K_trans = model.kernel_(inputs, model.X_train_)
-    pred = K_trans.dot(model.alpha_)
-    pred = model._y_train_std * pred + model._y_train_mean
-    v = cho_solve((model.L_, True), K_trans.T)
-    y_cov = model.kernel_(inputs) - K_trans.dot(v)
-    err = np.sqrt(np.diag(y_cov))
+def _load_cholesky(gp, fname_base):
+    ### the Cholesky factor of the training kernel matrix never changes, so it's computed once per surrogate.
+    ### it's read from (and, if EM_PE_SURROGATE_SAVE_FACTORS is set, saved to) a file next to the surrogate files,
+    ### along with a fingerprint of the GP it was computed for, so a factor from an older version of the surrogate
+    ### (or one that can't be read, e.g. while another process is writing it) is never used
+    fname = fname_base + "_L.npz"
+    fingerprint = design_fingerprint(gp)
+    n = gp.X_train_.shape[0]
+    if os.path.isfile(fname):
+        try:
+            with np.load(fname) as f:
+                if str(f["fingerprint"]) == fingerprint and f["L"].shape == (n, n):
+                    return f["L"]
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            pass
+    K = gp.kernel_(gp.X_train_)
+    K[np.diag_indices_from(K)] += gp.alpha
+    L = cholesky(K, lower=True)
+    if os.environ.get("EM_PE_SURROGATE_SAVE_FACTORS", "0") not in ("", "0"):
+        ### write to a temporary file first, so other processes never read a partial file
+        tmp_fname = fname + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tmp_fname, "wb") as f:
+                np.savez(f, L=L, fingerprint=np.array(fingerprint))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_fname, fname)
+        except OSError:
+            pass # e.g. a read-only surrogate directory
+    return L
+
+def _gp_data(gp):
+    ### the data needed to rebuild a loaded GP, in the form stored in surrogate archives (see scripts/pack_surrogates.py)
+    data = {
+            "X_train":np.asarray(gp.X_train_, dtype=float),
+            "y_train":np.asarray(gp.y_train_, dtype=float),
+            "alpha":np.asarray(gp.alpha_, dtype=float),
+            "noise_level":float(gp.kernel_.k1.noise_level),
+            "constant_value":float(gp.kernel_.k2.k1.constant_value),
+            "length_scale":np.atleast_1d(np.asarray(gp.kernel_.k2.k2.length_scale, dtype=float)),
+            "y_train_std":gp._y_train_std,
+            "y_train_mean":gp._y_train_mean,
+            "gp_alpha":float(gp.alpha)
+    }
+    if gp.L_ is not None:
+        data["L"] = gp.L_
+    return data
+
+def _gp_from_archive(data, fname_base, variance=True):
+    ### rebuild a GP from the data stored in a surrogate archive. the arrays are views of the memory-mapped archive
+    kernel = WhiteKernel(data["noise_level"]) + C(data["constant_value"]) * RBF(length_scale=data["length_scale"])
+    gp = GaussianProcessRegressor(kernel=kernel, alpha=data["gp_alpha"], n_restarts_optimizer=0)
+    gp.kernel_ = kernel
+    gp.X_train_ = data["X_train"]
+    gp.y_train_ = data["y_train"]
+    gp.alpha_ = data["alpha"]
+    gp._y_train_std = data["y_train_std"]
+    gp._y_train_mean = data["y_train_mean"]
+    gp.design_ = design_fingerprint(gp)
+    if not variance:
+        gp.L_ = None
+    elif "L" in data:
+        gp.L_ = data["L"]
+    else:
+        gp.L_ = _load_cholesky(gp, fname_base)
+    return gp
+
+def _get_gp(fname_base, variance=True, archive=None):
+    ### get the GP from the per-process surrogate cache, only loading it on a miss
+    return get_surrogate_cache().get((fname_base, variance), lambda key: _load_gp(fname_base, variance, archive))
+
+def _model_predict(models, inputs, lmbdas, variance=True):#, fix_log=False):
+    ### evaluate surrogates with the same training inputs and kernel (see shared_design_groups) for each wavelength
+    ### in lmbdas (the last input column), giving one row per wavelength, one column per input, and one entry in the
+    ### last axis per surrogate. their weights are stacked, so they're all evaluated with one matrix product, and the
+    ### error (which only depends on the shared design) is computed once.
+    ### model.L_ is computed when the surrogate is loaded (see _load_cholesky).
+    ### if the variance isn't needed, only the mean is computed and the error is zero
+    model = models[0]
+    if len(models) == 1:
+        pred, err = gp_predict_columns(model, inputs, 4, lmbdas, return_std=variance)
+        pred = (model._y_train_std * pred + model._y_train_mean)[:,:,np.newaxis]
+    else:
+        alpha = np.column_stack([m.alpha_ for m in models])
+        pred, err = gp_predict_columns(model, inputs, 4, lmbdas, return_std=variance, alpha=alpha)
+        pred = np.array([m._y_train_std for m in models]) * pred + np.array([m._y_train_mean for m in models])
+    err = np.broadcast_to(err[:,:,np.newaxis], pred.shape)
     
     ### temporary hack to fix log issue
     #if fix_log:
@@ -82,6 +165,10 @@ class kn_interp_angle(model_base):
         if interp_loc[-1] != "/":
             interp_loc += "/"
         interp_loc += "surrogate_data/2021_Wollaeger_TorusPeanut/"
+
+        ### if the surrogates have been packed into an archive (see scripts/pack_surrogates.py), memory-map it
+        archive_fname = interp_loc + "surrogates.bin"
+        self.archive = open_surrogate_archive(archive_fname) if os.path.isfile(archive_fname) else None
         
         self.angles = [0, 30, 45, 60, 75, 90]
 
@@ -110,6 +197,7 @@ class kn_interp_angle(model_base):
 
         self.params_array = None # internal storage of parameter array
         self.theta = None # internal storage of theta specifically (for convenience)
+        self.time_steps = {} # cached time steps used for each band (see _time_steps)
     
     def set_params(self, params, t_bounds):
         ### params should be a dictionary mapping parameter names to either single floats or 1d arrays.
@@ -135,74 +223,104 @@ class kn_interp_angle(model_base):
         self.params_array[:,2] = params["mej_wind"]
         self.params_array[:,3] = params["vej_wind"]
     
+    def _time_steps(self, tvec_days, band):
+        ### find the surrogate time steps bracketing the requested times. these only depend on the times,
+        ### so they're cached for each band and only recomputed if the band is evaluated at different times
+        cached = self.time_steps.get(band)
+        if cached is not None and (cached[0] is tvec_days or np.array_equal(cached[0], tvec_days)):
+            return cached[1], cached[2]
+        ### index of the time step at or before each time (times outside the grid don't use any time steps)
+        i = np.searchsorted(self.t_interp_full, tvec_days, side="right") - 1
+        i = i[(i >= 0) & (i < self.t_interp_full.size - 1)]
+        ind_list = np.unique(np.concatenate([i, i + 1])) # indices of the time steps that are used
+        t_interp = self.t_interp_full[ind_list] # times corresponding to these time steps
+        self.time_steps[band] = (np.copy(tvec_days), ind_list, t_interp)
+        return ind_list, t_interp
+
     def evaluate(self, tvec_days, band):
-        print(band + " band:")
-        self.params_array[:,4] = self.lmbda_dict[band]
-
-        ### find out which interpolators we actually need to use
-        ind_list = [] # list of interpolator indices (i.e. an integer 0, 1, ..., 190) that are used
-        t_interp = [] # list of times corresponding to these interpolators
-        for t in tvec_days:
-            for i in range(self.t_interp_full.size - 1):
-                if self.t_interp_full[i] <= t < self.t_interp_full[i + 1]:
-                    if i not in ind_list:
-                        t_interp.append(self.t_interp_full[i])
-                        ind_list.append(i)
-                    if i + 1 not in ind_list:
-                        t_interp.append(self.t_interp_full[i + 1])
-                        ind_list.append(i + 1)
-
-        t_interp = np.array(t_interp)
-
-        ### 2d arrays to hold the interpolator values.
+        return self.evaluate_bands({band:tvec_days})[band]
+
+    def evaluate_bands(self, obs_times):
+        bands = list(obs_times.keys())
+        lmbdas = np.array([self.lmbda_dict[band] for band in bands])
+
+        ### find out which interpolators we actually need to use for each band, and
+        ### map each of them to the (band index, column) pairs it's used for
+        time_steps = {band:self._time_steps(obs_times[band], band) for band in bands}
+        usage = {}
+        for band_index, band in enumerate(bands):
+            for lc_index, interp_index in enumerate(time_steps[band][0]):
+                usage.setdefault(interp_index, []).append((band_index, lc_index))
+
+        ### 2d arrays (one per band) to hold the interpolator values.
         ### each row is one light curve corresponding to the parameter values in that row of self.params_array.
-        ### each column is a time value corresponding to t_interp
-        mags_interp = np.empty((self.params_array.shape[0], t_interp.size))
-        mags_err_interp = np.empty((self.params_array.shape[0], t_interp.size))
-
-        for lc_index in range(t_interp.size):
-            if lc_index == 0 or (lc_index + 1) % 5 == 0:
-                print("  evaluating time step {} of {}".format(lc_index + 1, t_interp.size))
-            interp_index = ind_list[lc_index]
-            
-            ### iterate over angular bins
-            for angle_index in range(len(self.angles) - 1):
-                theta_lower = self.angles[angle_index]
-                theta_upper = self.angles[angle_index + 1]
-                delta_theta = float(theta_upper) - float(theta_lower)
-                param_indices = self.index_dict[(theta_lower, theta_upper)] # indices of self.params_array corresponding to this angular bin
-                if param_indices.size == 0: # skip loading and evaluating the interpolators if we have no points to evaluate
-                    continue
-                interp_lower = _load_gp(self.interpolators[theta_lower][interp_index])
-                interp_upper = _load_gp(self.interpolators[theta_upper][interp_index])
-                
-                ### evaluate the interpolator at this time step for the upper and lower angles
-                mags_lower, mags_err_lower = _model_predict(interp_lower, self.params_array[param_indices])#, fix_log=((interp_index >= 200) and theta_lower in [30, 45, 60]))
-                mags_upper, mags_err_upper = _model_predict(interp_upper, self.params_array[param_indices])#, fix_log=((interp_index >= 200) and theta_upper in [30, 45, 60]))
-                #if np.any(np.abs(mags_lower) > 100):
-                #    print(theta_lower, mags_lower)
-                #if np.any(np.abs(mags_upper) > 100):
-                #    print(theta_upper, mags_upper)
-
-                ### insert these values in the column of mags_interp corresponding to this time step and the row(s) corresponding to this angular bin
-                mags_interp[:,lc_index][param_indices] = ((theta_upper - self.theta[param_indices]) * mags_lower
-                        + (self.theta[param_indices] - theta_lower) * mags_upper) / delta_theta
-                mags_err_interp[:,lc_index][param_indices] = ((theta_upper - self.theta[param_indices]) * mags_err_lower
-                        + (self.theta[param_indices] - theta_lower) * mags_err_upper) / delta_theta
-                
+        ### each column is a time value corresponding to that band's t_interp
+        mags_interp = [np.empty((self.params_array.shape[0], time_steps[band][1].size)) for band in bands]
+        mags_err_interp = [np.empty((self.params_array.shape[0], time_steps[band][1].size)) for band in bands]
+
+        interp_indices = sorted(usage)
+        band_lists = [[band_index for band_index, _ in usage[interp_index]] for interp_index in interp_indices]
+
+        ### iterate over angular bins
+        for angle_index in range(len(self.angles) - 1):
+            theta_lower = self.angles[angle_index]
+            theta_upper = self.angles[angle_index + 1]
+            delta_theta = float(theta_upper) - float(theta_lower)
+            param_indices = self.index_dict[(theta_lower, theta_upper)] # indices of self.params_array corresponding to this angular bin
+            if param_indices.size == 0: # skip loading and evaluating the interpolators if we have no points to evaluate
+                continue
+            gps = {}
+            for theta in (theta_lower, theta_upper):
+                interps = [_get_gp(self.interpolators[theta][interp_index], variance=self.model_error, archive=self.archive)
+                           for interp_index in interp_indices]
+                gps[theta] = (interps, shared_design_groups(interps))
+
+            ### the samples are evaluated in chunks, to bound the memory used for the cross-kernels and the results
+            row_bytes = 8 * 4 * sum(len(band_list) for band_list in band_lists) + max(
+                    predict_row_bytes(interps[group[0]], len(bands), len(group)) for interps, groups in gps.values() for group in groups)
+            for chunk in self.row_chunks(param_indices.size, row_bytes):
+                indices = param_indices[chunk]
+                ### evaluate the interpolators at each time step for the upper and lower angles, in all the bands that use them
+                mags_lower, mags_err_lower = self._predict_time_steps(gps[theta_lower], band_lists, self.params_array[indices], lmbdas)
+                mags_upper, mags_err_upper = self._predict_time_steps(gps[theta_upper], band_lists, self.params_array[indices], lmbdas)
+                for k, interp_index in enumerate(interp_indices):
+                    ### insert these values in the column corresponding to this time step and the row(s) corresponding to this angular bin
+                    mags = ((theta_upper - self.theta[indices]) * mags_lower[k]
+                            + (self.theta[indices] - theta_lower) * mags_upper[k]) / delta_theta
+                    mags_err = ((theta_upper - self.theta[indices]) * mags_err_lower[k]
+                            + (self.theta[indices] - theta_lower) * mags_err_upper[k]) / delta_theta
+                    for m, (band_index, lc_index) in enumerate(usage[interp_index]):
+                        mags_interp[band_index][indices,lc_index] = mags[m]
+                        mags_err_interp[band_index][indices,lc_index] = mags_err[m]
+
+        return {band:self._interpolate(mags_interp[i], mags_err_interp[i], time_steps[band][1], obs_times[band], band)
+                for i, band in enumerate(bands)}
+
+    def _predict_time_steps(self, gps, band_lists, inputs, lmbdas):
+        ### evaluate the interpolators for one angle (and their groups, see shared_design_groups) at the given inputs.
+        ### each group is evaluated together, in every band used by any of its interpolators. returns lists with one
+        ### entry per interpolator, each an array with one row per band in its band_list and one column per input
+        interps, groups = gps
+        mags = [None] * len(interps)
+        mags_err = [None] * len(interps)
+        for group in groups:
+            band_indices = sorted(set(band_index for i in group for band_index in band_lists[i]))
+            group_mags, group_mags_err = _model_predict([interps[i] for i in group], inputs, lmbdas[band_indices], variance=self.model_error)
+            for k, i in enumerate(group):
+                rows = [band_indices.index(band_index) for band_index in band_lists[i]]
+                mags[i] = group_mags[rows,:,k]
+                mags_err[i] = group_mags_err[rows,:,k]
+        return mags, mags_err
+
+    def _interpolate(self, mags_interp, mags_err_interp, t_interp, tvec_days, band):
         ### now we need to construct the light curves at the user-requested times
-        ### start by creating empty arrays with rows corresponding to rows of self.params_array and columns corresponding to the user-requested times
-        mags_out = np.empty((self.params_array.shape[0], tvec_days.size))
-        mags_err_out = np.empty((self.params_array.shape[0], tvec_days.size))
-        
-        ### iterate over light curves (or parameter combinations, depending on how you look at it)
-        for i in range(self.params_array.shape[0]):
-            ### make a 1d interpolator for magnitudes and another for errors
-            mags_interpolator = interp1d(t_interp, mags_interp[i], fill_value="extrapolate")
-            mags_err_interpolator = interp1d(t_interp, mags_err_interp[i], fill_value="extrapolate")
-            ### evaluate
-            mags_out[i] = mags_interpolator(tvec_days)
-            mags_err_out[i] = mags_err_interpolator(tvec_days)
+        stencil = self.get_stencil(t_interp, tvec_days, band)
+        if stencil is None:
+            ### not the registered observation times, so work out the interpolation for just this call
+            stencil = interp_stencil(t_interp, tvec_days)
+        ### interpolate (or extrapolate) all the light curves at once
+        mags_out = stencil(mags_interp)
+        mags_err_out = stencil(mags_err_interp)
         
         if self.params_array.shape[0] == 1:
             ### if the model is being used in non-vectorized form, return 1d arrays
@@ -5,6 +5,125 @@ Model
 Base class for lightcurve models
 '''
 from __future__ import print_function
+import numpy as np
+import copy
+import os
+
+class interp_stencil:
+    '''
+    Precomputed linear interpolation from a fixed set of points to another
+    fixed set of points. The bracketing indices and weights are computed once,
+    so interpolating any number of rows is a single gather-and-multiply. Gives
+    the same result as ``interp1d(x, y[i], fill_value="extrapolate")(x_new)``
+    for each row i.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        1d array of points the data is tabulated at (need not be sorted)
+    x_new : np.ndarray
+        Points to interpolate to
+    '''
+    def __init__(self, x, x_new):
+        self.x = x
+        self.x_new = x_new
+        ### work with sorted points (like interp1d), but index into the original order
+        order = np.argsort(x, kind='mergesort')
+        x_sorted = x[order]
+        ### index of the first point >= x_new, clipped so the end segments are used for extrapolation
+        ind = np.clip(np.searchsorted(x_sorted, x_new), 1, x.size - 1)
+        self.lo = order[ind - 1]
+        self.hi = order[ind]
+        self.dx = x_sorted[ind] - x_sorted[ind - 1]
+        self.offset = x_new - x_sorted[ind - 1]
+
+    def __call__(self, y):
+        '''
+        Interpolate every row of y.
+
+        Parameters
+        ----------
+        y : np.ndarray
+            2d array with one row per lightcurve, and one column per value of x
+
+        Returns
+        -------
+        np.ndarray
+            2d array with one column per value of x_new
+        '''
+        y_lo = y[:,self.lo]
+        slope = (y[:,self.hi] - y_lo) / self.dx
+        return slope * self.offset + y_lo
+
+def merge_stencils(stencils):
+    '''
+    Combine interpolation stencils from the same grid, so that the data only
+    needs to be computed at the grid points used by at least one of them.
+
+    Parameters
+    ----------
+    stencils : dict
+        Dictionary mapping band names to interp_stencil objects
+
+    Returns
+    -------
+    (np.ndarray, dict)
+        Sorted indices of the grid points needed, and a dictionary mapping
+        band names to stencils that index into just those grid points
+    '''
+    columns = np.unique(np.concatenate([np.concatenate([s.lo, s.hi]) for s in stencils.values()]))
+    merged = {}
+    for band, stencil in stencils.items():
+        merged[band] = copy.copy(stencil)
+        merged[band].lo = np.searchsorted(columns, stencil.lo)
+        merged[band].hi = np.searchsorted(columns, stencil.hi)
+    return columns, merged
+
+def interp_rows(x, y, x_new, mask=None):
+    '''
+    Linearly interpolate (or extrapolate) every row of a 2d array at once.
+    Gives the same result as applying
+    ``interp1d(x[mask[i]], y[i][mask[i]], fill_value="extrapolate")(x_new)``
+    to each row i.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sorted 1d array of points the rows of y are tabulated at
+    y : np.ndarray
+        2d array with one row per lightcurve
+    x_new : np.ndarray
+        Points to interpolate to
+    mask : np.ndarray
+        Optional boolean array (same shape as y) of the values to use, e.g.
+        only the finite ones
+
+    Returns
+    -------
+    np.ndarray
+        2d array with one row per row of y and one column per value in x_new.
+        Rows with fewer than two usable values are NaN.
+    '''
+    if mask is None:
+        return interp_stencil(x, x_new)(y)
+    ### index of the first point >= x_new (same convention as interp1d)
+    j = np.searchsorted(x, x_new)
+    ### number of usable points before each grid index, for each row
+    n_before = np.zeros((y.shape[0], x.size + 1), dtype=int)
+    n_before[:,1:] = np.cumsum(mask, axis=1)
+    n_good = n_before[:,-1:]
+    ind = np.clip(n_before[:,j], 1, np.maximum(n_good - 1, 1))
+    ### grid indices of the usable points, in order, for each row
+    order = np.argsort(np.logical_not(mask), axis=1, kind='stable')
+    lo = np.take_along_axis(order, ind - 1, axis=1)
+    hi = np.take_along_axis(order, ind, axis=1)
+    y_lo = np.take_along_axis(y, lo, axis=1)
+    y_hi = np.take_along_axis(y, hi, axis=1)
+    x_lo, x_hi = x[lo], x[hi]
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    ret = slope * (x_new - x_lo) + y_lo
+    ret[n_good[:,0] < 2] = np.nan
+    return ret
 
 class model_base:
     '''
@@ -28,6 +147,12 @@ class model_base:
         self.params = None
         self.t_bounds = None
         self.vectorized = False # child classes should set this to True if vectorized evaluations are allowed
+        self.model_error = True # if False, the model error isn't needed and child classes may return zeros for it
+        ### approximate limit (in MB) on the temporary memory used by vectorized evaluations (see row_chunks)
+        self.memory_mb = float(os.environ.get("EM_PE_MODEL_MEMORY_MB", 256))
+        self.obs_times = {} # observation times registered for each band (see set_obs_times)
+        self.stencils = {} # cached interpolation stencils for the registered times
+        self.merged_stencils = None # cached output of merge_stencils (see get_merged_stencils)
 
     def set_params(self, params, t_bounds):
         '''
@@ -44,6 +169,118 @@ class model_base:
         self.params = params
         self.t_bounds = t_bounds
 
+    def set_obs_times(self, obs_times):
+        '''
+        Register the times each band will be evaluated at, so that child
+        classes can precompute how to interpolate their lightcurves to them.
+
+        Parameters
+        ----------
+        obs_times : dict
+            Dictionary mapping band names to arrays of observation times
+        '''
+        self.obs_times = dict(obs_times)
+        self.stencils = {}
+        self.merged_stencils = None
+
+    def get_stencil(self, x, tvec_days, band):
+        '''
+        Get a (cached) interpolation stencil from the points x to the times
+        tvec_days, if those are the registered observation times for the band.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Points the model lightcurves are computed at
+        tvec_days : np.ndarray
+            Times the model is being evaluated at
+        band : string
+            Band being evaluated
+
+        Returns
+        -------
+        interp_stencil or None
+            The stencil, or None if tvec_days aren't the registered times
+        '''
+        t_obs = self.obs_times.get(band)
+        if t_obs is None or (tvec_days is not t_obs and not np.array_equal(tvec_days, t_obs)):
+            return None
+        stencil = self.stencils.get(band)
+        if stencil is None or (stencil.x is not x and not np.array_equal(stencil.x, x)):
+            stencil = interp_stencil(x, t_obs)
+            self.stencils[band] = stencil
+        return stencil
+
+    def get_merged_stencils(self, x, obs_times):
+        '''
+        Get (cached) merged interpolation stencils from the points x to the
+        registered observation times of several bands (see merge_stencils).
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Points the model lightcurves are computed at
+        obs_times : dict
+            Dictionary mapping band names to the times they're evaluated at
+
+        Returns
+        -------
+        (np.ndarray, dict) or None
+            Output of merge_stencils, or None if any of the bands' times
+            aren't the registered ones
+        '''
+        stencils = {}
+        for band, tvec_days in obs_times.items():
+            stencils[band] = self.get_stencil(x, tvec_days, band)
+            if stencils[band] is None:
+                return None
+        if self.merged_stencils is not None:
+            old_stencils, columns, merged = self.merged_stencils
+            if old_stencils.keys() == stencils.keys() and all(old_stencils[band] is stencils[band] for band in stencils):
+                return columns, merged
+        columns, merged = merge_stencils(stencils)
+        self.merged_stencils = (stencils, columns, merged)
+        return columns, merged
+
+    def row_chunks(self, n_rows, row_bytes):
+        '''
+        Split the rows (samples) of a vectorized evaluation into chunks that
+        can be evaluated one after another within the memory budget
+        (self.memory_mb).
+
+        Parameters
+        ----------
+        n_rows : int
+            Number of rows
+        row_bytes : int
+            Approximate temporary memory needed per row, in bytes
+
+        Returns
+        -------
+        list
+            List of slices covering range(n_rows)
+        '''
+        chunk_size = max(1, int(self.memory_mb * 1024**2 // max(row_bytes, 1)))
+        return [slice(start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+
+    def evaluate_bands(self, obs_times):
+        '''
+        Evaluate the model in several bands using the current parameters.
+        Child classes can override this when most of the work can be shared
+        between bands.
+
+        Parameters
+        ----------
+        obs_times : dict
+            Dictionary mapping band names to arrays of time values
+
+        Returns
+        -------
+        dict
+            Dictionary mapping band names to the output of evaluate()
+        '''
+        return {band:self.evaluate(tvec_days, band) for band, tvec_days in obs_times.items()}
+
     ### Functions that should be implemented by child classes.
     ### NOTE: These could be seen as (and maybe should be) abstract methods
 
@@ -60,3 +297,187 @@ class model_base:
             Band to evaluate
         '''
         pass
+
+class blackbody_model(model_base):
+    '''
+    Base class for vectorized models whose lightcurves come from one or more
+    blackbody photospheres computed on a time grid (e.g. kilonova and
+    kilonova_3c). Child classes set self.tdays, self.n_rows, self.scalar and
+    self.sigma in set_params, and implement _photosphere and _row_bytes.
+
+    Parameters
+    ----------
+    name : string
+        Name of the model
+    param_names : list
+        Names of parameters
+    bands : list
+        Names of data bands
+    '''
+    def __init__(self, name, param_names, bands):
+        model_base.__init__(self, name, param_names, bands)
+        self.vectorized = True
+        self.lmbda_dict = { # dictionary of wavelengths corresponding to bands
+                "u":354.3,
+                "g":477.56,
+                "r":612.95,
+                "i":748.46,
+                "z":865.78,
+                "y":960.31,
+                "J":1235.0,
+                "H":1662.0,
+                "K":2159.0
+        }
+        self.tdays = None # time grid (days) the photosphere is computed on
+        self.n_rows = 0 # number of lightcurves
+        self.scalar = False # True if the current parameters are single floats rather than arrays
+        self.sigma = None # model error
+
+    def _mAB(self, nu, rows, columns=None):
+        '''
+        Compute the AB magnitudes of the photosphere(s) on the time grid.
+
+        Parameters
+        ----------
+        nu : float or np.ndarray
+            Frequency (Hz), or array of frequencies with shape (n_bands, 1, 1)
+        rows : slice or np.ndarray
+            Lightcurves to compute (slice or array of indices)
+        columns : np.ndarray
+            Optional indices of the grid times to use (default all of them)
+
+        Returns
+        -------
+        np.ndarray
+            Magnitudes with one row per lightcurve and one column per grid
+            time, with an extra leading axis if nu is an array
+        '''
+        c = 2.99792458e10 # cm/s
+        h = 6.626e-27 # erg * s
+        kb = 1.38e-16 # erg/K
+        Mpc = 3.08e24 # cm
+        D = 1.0e-5 * Mpc # fiducial distance
+
+        ### sum the flux of every photosphere component
+        F_nu = 0.0
+        for R_photo, T_photo in zip(*self._photosphere(rows)):
+            if columns is not None:
+                R_photo = R_photo[:,columns]
+                T_photo = T_photo[:,columns]
+            B_nu = (2.0 * h * nu**3 / c**2) / np.expm1(h * nu / (kb * T_photo))
+            F_nu += B_nu * np.pi * R_photo**2 / D**2
+        return -2.5 * np.log10(F_nu) - 48.6
+
+    def _nu(self, band):
+        ### frequency (Hz) of the band
+        c = 2.99792458e10 # cm/s
+        lmbda = self.lmbda_dict[band] * 1.0e-7 # convert to cm
+        return c / lmbda
+
+    def _output(self, mags):
+        ### format the interpolated magnitudes and the model error like evaluate()
+        if self.scalar:
+            return mags[0], self.sigma
+        return mags, np.reshape(self.sigma, (-1, 1))
+
+    def evaluate(self, tvec_days, band):
+        '''
+        Evaluate model at specific time values using the current parameters.
+
+        Parameters
+        ----------
+        tvec_days : np.ndarray
+            Time values
+        band : string
+            Band to evaluate
+
+        Returns
+        -------
+        (np.ndarray, float or np.ndarray)
+            Magnitudes and model error. If the parameters were arrays, the
+            magnitudes have one row per lightcurve and the error is a column
+            vector.
+        '''
+        if self.get_stencil(self.tdays, tvec_days, band) is not None:
+            return self.evaluate_bands({band:tvec_days})[band]
+        mags = np.empty((self.n_rows, np.size(tvec_days)))
+        for rows in self.row_chunks(self.n_rows, self._row_bytes(1)):
+            mAB = self._mAB(self._nu(band), rows)
+            mask = np.isfinite(mAB)
+            mags[rows] = interp_rows(self.tdays, mAB, tvec_days, mask=(None if mask.all() else mask))
+        return self._output(mags)
+
+    def evaluate_bands(self, obs_times):
+        '''
+        Evaluate the model in several bands at once. If the times are the
+        registered observation times, the magnitudes for all the bands are
+        computed together, and only at the grid times needed to interpolate to
+        the observation times.
+
+        Parameters
+        ----------
+        obs_times : dict
+            Dictionary mapping band names to arrays of time values
+
+        Returns
+        -------
+        dict
+            Dictionary mapping band names to the output of evaluate()
+        '''
+        merged = self.get_merged_stencils(self.tdays, obs_times)
+        if merged is None:
+            return model_base.evaluate_bands(self, obs_times)
+        columns, stencils = merged
+        bands = list(obs_times.keys())
+        nu = np.array([self._nu(band) for band in bands]).reshape((-1, 1, 1))
+        mags = [np.empty((self.n_rows, np.size(obs_times[band]))) for band in bands]
+        ### evaluate the lightcurves in chunks, to bound the memory used for the time grid
+        for rows in self.row_chunks(self.n_rows, self._row_bytes(len(bands))):
+            mAB = self._mAB(nu, rows, columns=columns)
+            for i, band in enumerate(bands):
+                mags[i][rows] = stencils[band](mAB[i])
+            ### rows where the points bracketing the observation times aren't all
+            ### finite have to be interpolated using only their finite values
+            bad = np.logical_not(np.all([np.all(np.isfinite(m[rows]), axis=1) for m in mags], axis=0))
+            if np.any(bad):
+                bad = np.arange(self.n_rows)[rows][bad]
+                mAB_bad = self._mAB(nu, bad)
+                for i, band in enumerate(bands):
+                    mags[i][bad] = interp_rows(self.tdays, mAB_bad[i], obs_times[band], mask=np.isfinite(mAB_bad[i]))
+        return {band:self._output(mags[i]) for i, band in enumerate(bands)}
+
+    ### Functions that should be implemented by child classes.
+
+    def _photosphere(self, rows):
+        '''
+        Compute the photosphere radius and temperature on the time grid.
+
+        Parameters
+        ----------
+        rows : slice or np.ndarray
+            Lightcurves to compute (slice or array of indices)
+
+        Returns
+        -------
+        (list, list)
+            Radii (cm) and temperatures (K) of each photosphere component,
+            as arrays with one row per lightcurve and one column per grid time
+        '''
+        pass
+
+    def _row_bytes(self, n_bands):
+        '''
+        Approximate temporary memory per lightcurve used by _photosphere and
+        _mAB when evaluating n_bands bands (see model_base.row_chunks).
+
+        Parameters
+        ----------
+        n_bands : int
+            Number of bands evaluated together
+
+        Returns
+        -------
+        int
+            Number of bytes
+        '''
+        pass
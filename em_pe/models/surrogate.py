@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+'''
+Surrogate
+---------
+Utilities shared by the surrogate-based (Gaussian process) models
+'''
+from __future__ import print_function
+import numpy as np
+import os
+import json
+import struct
+import hashlib
+import shutil
+from collections import OrderedDict
+from scipy.linalg import solve_triangular
+from scipy.spatial.distance import cdist
+from sklearn.gaussian_process.kernels import RBF, WhiteKernel, ConstantKernel, Sum, Product
+
+def predictive_variance(L, K_trans, kernel_diag, chunk_size=4096):
+    '''
+    Compute the predictive variance of a Gaussian process at a set of points,
+    without forming the full predictive covariance matrix. Equivalent to
+    ``np.diag(kernel(X) - K_trans.dot(cho_solve((L, True), K_trans.T)))``,
+    but the memory used only grows linearly with the number of points.
+
+    Parameters
+    ----------
+    L : np.ndarray
+        Lower Cholesky factor of the training kernel matrix
+    K_trans : np.ndarray
+        Kernel between the points and the training inputs, with one row per
+        point
+    kernel_diag : np.ndarray
+        Prior variance (diagonal of the kernel) at the points
+    chunk_size : int
+        Number of points to do each triangular solve for
+
+    Returns
+    -------
+    np.ndarray
+        Predictive variance at each point
+    '''
+    var = np.array(kernel_diag, dtype=float)
+    for start in range(0, K_trans.shape[0], chunk_size):
+        v = solve_triangular(L, K_trans[start:start + chunk_size].T, lower=True, check_finite=False)
+        var[start:start + chunk_size] -= np.einsum("ij,ij->j", v, v)
+    return var
+
+def gp_predict(gp, inputs, return_std=True, alpha=None):
+    '''
+    Evaluate a fitted Gaussian process (anything with the attributes of a
+    fitted scikit-learn GaussianProcessRegressor: kernel_, X_train_, alpha_
+    and L_), before undoing any normalisation of the training data.
+
+    Parameters
+    ----------
+    gp : GaussianProcessRegressor
+        The Gaussian process
+    inputs : np.ndarray
+        Points to evaluate it at, with one row per point
+    return_std : bool
+        Whether to compute the predictive standard deviation. If False, only
+        the mean is computed and the standard deviation is returned as zeros.
+    alpha : np.ndarray
+        Weights to use instead of gp.alpha_. If this is 2d (one column per
+        set of weights), e.g. for several GPs with the same training inputs
+        and kernel (see shared_design_groups), the mean has one column per
+        set of weights.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Predictive mean and standard deviation at each point
+    '''
+    if alpha is None:
+        alpha = gp.alpha_
+    K_trans = gp.kernel_(inputs, gp.X_train_)
+    mean = K_trans.dot(alpha)
+    if not return_std:
+        return mean, np.zeros(inputs.shape[0])
+    std = np.sqrt(predictive_variance(gp.L_, K_trans, gp.kernel_.diag(inputs)))
+    return mean, std
+
+def predict_row_bytes(gp, n_values=1, n_weights=1):
+    '''
+    Approximate temporary memory used per point by gp_predict or
+    gp_predict_columns, for choosing how many points to evaluate at once
+    (see model_base.row_chunks).
+
+    Parameters
+    ----------
+    gp : object
+        The Gaussian process
+    n_values : int
+        Number of values of the varying column (see gp_predict_columns)
+    n_weights : int
+        Number of sets of weights (see gp_predict)
+
+    Returns
+    -------
+    int
+        Bytes per point
+    '''
+    n_train = gp.X_train_.shape[0] if hasattr(gp, "X_train_") else 1000 # (a guess, for other GP implementations)
+    ### the cross-kernel, its product with the varying column's factor, the triangular solve, and the output
+    return 8 * (3 * n_train + n_values * (n_weights + 1))
+
+def _rbf_parts(kernel):
+    ### (constant, length scale) if the kernel is a constant times an RBF kernel, optionally plus a white noise kernel.
+    ### otherwise None
+    if isinstance(kernel, Sum) and isinstance(kernel.k1, WhiteKernel):
+        kernel = kernel.k2
+    if isinstance(kernel, Product) and isinstance(kernel.k1, ConstantKernel) and type(kernel.k2) is RBF: # (Matern is a subclass of RBF)
+        return kernel.k1.constant_value, kernel.k2.length_scale
+    return None
+
+def gp_predict_columns(gp, inputs, column, values, return_std=True, alpha=None):
+    '''
+    Evaluate a fitted Gaussian process (see gp_predict) at the same inputs for
+    several values of one input column (e.g. the wavelength, for each band).
+    For a (white noise plus) constant times RBF kernel, the kernel factorises
+    over the input dimensions, so the part from the other columns is only
+    computed once and multiplied by a cheap factor for each value. (This is
+    used by kn_interp_angle; the kn_interp surrogates don't expose their
+    kernel, so they can't use it.)
+
+    Parameters
+    ----------
+    gp : GaussianProcessRegressor
+        The Gaussian process
+    inputs : np.ndarray
+        Points to evaluate it at, with one row per point (the values in the
+        varying column are ignored)
+    column : int
+        Index of the varying column
+    values : np.ndarray
+        Values to use for the varying column
+    return_std : bool
+        Whether to compute the predictive standard deviation (see gp_predict)
+    alpha : np.ndarray
+        Weights to use instead of gp.alpha_ (see gp_predict)
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Predictive mean and standard deviation, with one row per value and one
+        column per point. If alpha is 2d, the mean has an extra last axis with
+        one entry per set of weights.
+    '''
+    if alpha is None:
+        alpha = gp.alpha_
+    parts = _rbf_parts(gp.kernel_)
+    if parts is None:
+        mean = np.empty((len(values), inputs.shape[0]) + alpha.shape[1:])
+        std = np.empty((len(values), inputs.shape[0]))
+        inputs = np.array(inputs, dtype=float)
+        for i, value in enumerate(values):
+            inputs[:,column] = value
+            mean[i], std[i] = gp_predict(gp, inputs, return_std=return_std, alpha=alpha)
+        return mean, std
+    constant, length_scale = parts
+    X = gp.X_train_
+    length_scale = np.broadcast_to(np.asarray(length_scale, dtype=float), (X.shape[1],))
+    other = np.arange(X.shape[1]) != column
+    ### kernel from the other columns, and the factor from the varying column for each value
+    K_other = constant * np.exp(-0.5 * cdist(inputs[:,other] / length_scale[other], X[:,other] / length_scale[other], metric="sqeuclidean"))
+    factors = np.exp(-0.5 * (np.reshape(values, (-1, 1)) / length_scale[column] - X[:,column] / length_scale[column])**2)
+    if alpha.ndim == 1:
+        mean = K_other.dot((factors * alpha).T).T
+    else:
+        ### all the values and sets of weights are done in one matrix product
+        weights = factors[:,:,np.newaxis] * alpha[np.newaxis,:,:]
+        mean = K_other.dot(np.reshape(np.transpose(weights, (1, 0, 2)), (X.shape[0], -1)))
+        mean = np.transpose(np.reshape(mean, (inputs.shape[0], len(values), alpha.shape[1])), (1, 0, 2))
+    if not return_std:
+        return mean, np.zeros((len(values), inputs.shape[0]))
+    kernel_diag = gp.kernel_.diag(inputs) # doesn't depend on the varying column
+    std = np.empty((len(values), inputs.shape[0]))
+    for i in range(len(values)):
+        std[i] = np.sqrt(predictive_variance(gp.L_, K_other * factors[i], kernel_diag))
+    return mean, std
+
+def design_fingerprint(gp):
+    '''
+    Fingerprint of a fitted Gaussian process's training kernel matrix: a hash
+    of its training inputs, kernel hyperparameters and noise. GPs with the
+    same fingerprint only differ by their weights (alpha_).
+
+    Parameters
+    ----------
+    gp : GaussianProcessRegressor
+        The Gaussian process
+
+    Returns
+    -------
+    string
+        Hex digest of the hash
+    '''
+    h = hashlib.sha1()
+    h.update(type(gp.kernel_).__name__.encode())
+    h.update(np.ascontiguousarray(gp.X_train_, dtype=float).tobytes())
+    params = gp.kernel_.get_params()
+    for hyperparameter in gp.kernel_.hyperparameters:
+        h.update(hyperparameter.name.encode())
+        h.update(np.ascontiguousarray(params[hyperparameter.name], dtype=float).tobytes())
+    h.update(np.ascontiguousarray(gp.alpha, dtype=float).tobytes())
+    return h.hexdigest()
+
+def shared_design_groups(gps):
+    '''
+    Group fitted Gaussian processes that have the same training inputs, kernel
+    and noise, so they only differ by their weights. The GPs in a group share
+    their cross-kernel and predictive variance, so they can be evaluated
+    together by passing their stacked weights to gp_predict or
+    gp_predict_columns.
+
+    Parameters
+    ----------
+    gps : list
+        The Gaussian processes. They're grouped by their design_ attribute
+        (see design_fingerprint), which should be set when they're loaded;
+        any without one get a group of their own.
+
+    Returns
+    -------
+    list
+        List of groups, each a list of indices into gps (in order of their
+        first GP)
+    '''
+    groups = {}
+    for i, gp in enumerate(gps):
+        key = getattr(gp, "design_", None)
+        groups.setdefault(i if key is None else key, []).append(i)
+    return list(groups.values())
+
+def _nbytes(obj):
+    '''
+    Estimate the memory used by a loaded surrogate, by adding up the sizes of
+    the numpy arrays it holds.
+    '''
+    if isinstance(obj, np.memmap):
+        return 0 # backed by a file, and shared between processes
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(o) for o in obj.values())
+    if hasattr(obj, "__dict__"):
+        return sum(_nbytes(o) for o in vars(obj).values())
+    return 0
+
+class surrogate_cache:
+    '''
+    Least-recently-used cache of loaded surrogates, bounded by the total
+    memory they use rather than by their number.
+
+    Parameters
+    ----------
+    max_mb : float
+        Memory budget in MB. The least recently used surrogates are dropped
+        when the total goes over the budget (the most recent one is always
+        kept).
+    '''
+    def __init__(self, max_mb):
+        self.max_bytes = max_mb * 1024.0**2
+        self.surrogates = OrderedDict() # maps keys to (surrogate, size in bytes) pairs
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        '''
+        Get a surrogate from the cache, loading it if necessary.
+
+        Parameters
+        ----------
+        key : hashable
+            Key identifying the surrogate (e.g. its file name)
+        load : function
+            Function that loads the surrogate, called as load(key) on a miss
+
+        Returns
+        -------
+        object
+            The surrogate
+        '''
+        if key in self.surrogates:
+            self.hits += 1
+            self.surrogates.move_to_end(key)
+            return self.surrogates[key][0]
+        self.misses += 1
+        surrogate = load(key)
+        size = _nbytes(surrogate)
+        self.surrogates[key] = (surrogate, size)
+        self.nbytes += size
+        self._evict()
+        return surrogate
+
+    def clear(self):
+        '''
+        Remove all the surrogates from the cache (the counters are kept).
+        '''
+        self.surrogates.clear()
+        self.nbytes = 0
+
+    def set_max_mb(self, max_mb):
+        '''
+        Change the memory budget, dropping the least recently used surrogates
+        if the cache is now over it.
+
+        Parameters
+        ----------
+        max_mb : float
+            Memory budget in MB
+        '''
+        self.max_bytes = max_mb * 1024.0**2
+        self._evict()
+
+    def _evict(self):
+        ### drop the least recently used surrogates until the cache is within its budget
+        while self.nbytes > self.max_bytes and len(self.surrogates) > 1:
+            _, (_, old_size) = self.surrogates.popitem(last=False)
+            self.nbytes -= old_size
+
+    def __len__(self):
+        return len(self.surrogates)
+
+    def __repr__(self):
+        return "surrogate_cache: {} surrogates, {:.1f} of {:.1f} MB, {} hits, {} misses".format(
+                len(self.surrogates), self.nbytes / 1024.0**2, self.max_bytes / 1024.0**2, self.hits, self.misses)
+
+_cache = None
+
+def get_surrogate_cache():
+    '''
+    Get the surrogate cache shared by all the models in this process. Its
+    memory budget (in MB) is read from the EM_PE_SURROGATE_CACHE_MB
+    environment variable, and defaults to 1024 (see set_surrogate_cache_mb to
+    change it).
+
+    Returns
+    -------
+    surrogate_cache
+        The shared cache
+    '''
+    global _cache
+    if _cache is None:
+        _cache = surrogate_cache(float(os.environ.get("EM_PE_SURROGATE_CACHE_MB", 1024)))
+    return _cache
+
+def set_surrogate_cache_mb(max_mb):
+    '''
+    Set the memory budget of the surrogate cache shared by all the models in
+    this process (overriding EM_PE_SURROGATE_CACHE_MB).
+
+    Parameters
+    ----------
+    max_mb : float
+        Memory budget in MB
+    '''
+    get_surrogate_cache().set_max_mb(float(max_mb))
+
+### binary surrogate archives: the magic string, the length of the JSON header
+### (as a little-endian 64-bit integer), the header, then the arrays.
+### each array starts on a multiple of _ARCHIVE_ALIGN bytes from the start of the file
+_ARCHIVE_MAGIC = b"EMPESURR"
+_ARCHIVE_VERSION = 1
+_ARCHIVE_ALIGN = 64
+
+def _align(n):
+    return -(-n // _ARCHIVE_ALIGN) * _ARCHIVE_ALIGN
+
+def write_surrogate_archive(fname, surrogates):
+    '''
+    Write a set of surrogates to a single binary file that can be
+    memory-mapped by surrogate_archive. The surrogates' arrays are written
+    out one surrogate at a time, so if they're passed as an iterator, only
+    one surrogate has to be in memory at once.
+
+    Parameters
+    ----------
+    fname : string
+        File to write
+    surrogates : dict or iterable
+        Dictionary mapping surrogate names to dictionaries of their data, or
+        an iterable (e.g. a generator) of (name, data) pairs. Values that are
+        numpy arrays are stored in binary form, anything else must be
+        JSON-serialisable and is stored in the header.
+    '''
+    if isinstance(surrogates, dict):
+        surrogates = surrogates.items()
+    ### the header (which comes first) isn't known until every surrogate has been seen, so the arrays are
+    ### written to a temporary file as they come, then copied after the header
+    data_fname = fname + ".data.tmp"
+    tmp_fname = fname + ".tmp"
+    try:
+        with open(data_fname, "w+b") as data_file:
+            index = {}
+            offset = 0
+            for name, data in surrogates:
+                entry = {"arrays":{}, "values":{}}
+                for key, value in data.items():
+                    if isinstance(value, np.ndarray):
+                        value = np.ascontiguousarray(value)
+                        entry["arrays"][key] = [offset, value.dtype.str, list(value.shape)]
+                        data_file.seek(offset)
+                        data_file.write(value.tobytes())
+                        offset = _align(offset + value.nbytes)
+                    else:
+                        entry["values"][key] = value
+                index[name] = entry
+            header = json.dumps({"version":_ARCHIVE_VERSION, "surrogates":index}).encode()
+            data_start = _align(len(_ARCHIVE_MAGIC) + 8 + len(header))
+            with open(tmp_fname, "wb") as f:
+                f.write(_ARCHIVE_MAGIC)
+                f.write(struct.pack("<q", len(header)))
+                f.write(header)
+                f.seek(data_start)
+                data_file.seek(0)
+                shutil.copyfileobj(data_file, f, 16 * 1024**2)
+                f.truncate(data_start + offset)
+        ### only replace an existing archive (which a model may be using) once the new one is complete
+        os.replace(tmp_fname, fname)
+    finally:
+        for name in (data_fname, tmp_fname):
+            if os.path.exists(name):
+                os.remove(name)
+
+class surrogate_archive:
+    '''
+    Read-only view of a file written by write_surrogate_archive. The file is
+    memory-mapped, so opening it is cheap, data is only read from disk when
+    it's used, and processes using the same archive share its pages.
+
+    Parameters
+    ----------
+    fname : string
+        Archive file name
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.directory = os.path.dirname(os.path.abspath(fname))
+        with open(fname, "rb") as f:
+            if f.read(len(_ARCHIVE_MAGIC)) != _ARCHIVE_MAGIC:
+                raise ValueError("not a surrogate archive: " + fname)
+            (header_length,) = struct.unpack("<q", f.read(8))
+            header = json.loads(f.read(header_length).decode())
+        if header["version"] != _ARCHIVE_VERSION:
+            raise ValueError("unsupported surrogate archive version: " + str(header["version"]))
+        self.index = header["surrogates"]
+        self.data_start = _align(len(_ARCHIVE_MAGIC) + 8 + header_length)
+        self.mm = np.memmap(fname, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, name):
+        '''
+        Get the data for one surrogate.
+
+        Parameters
+        ----------
+        name : string
+            Name of the surrogate
+
+        Returns
+        -------
+        dict
+            Dictionary of the surrogate's data, with arrays as (read-only)
+            views of the memory-mapped file
+        '''
+        entry = self.index[name]
+        ret = dict(entry["values"])
+        for key, (offset, dtype, shape) in entry["arrays"].items():
+            dtype = np.dtype(dtype)
+            start = self.data_start + offset
+            size = dtype.itemsize * int(np.prod(shape))
+            ret[key] = self.mm[start:start + size].view(dtype).reshape(shape)
+        return ret
+
+_archives = {}
+
+def open_surrogate_archive(fname):
+    '''
+    Open a surrogate archive, reusing it if it's already been opened in this
+    process.
+
+    Parameters
+    ----------
+    fname : string
+        Archive file name
+
+    Returns
+    -------
+    surrogate_archive
+        The archive
+    '''
+    fname = os.path.abspath(fname)
+    if fname not in _archives:
+        _archives[fname] = surrogate_archive(fname)
+    return _archives[fname]
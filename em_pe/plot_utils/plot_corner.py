@@ -4,6 +4,19 @@ from __future__ import print_function
 import numpy as np
 import corner
 import argparse
+import os
+import importlib.util
+
+def _load_sample_file():
+    ### load sample_file.py on its own: importing it through the em_pe package would run em_pe/__init__.py,
+    ### which imports the whole inference stack (astropy, lal, RIFT) that this script doesn't need
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "sample_file.py")
+    spec = importlib.util.spec_from_file_location("_em_pe_sample_file", fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+read_samples = _load_sample_file().read_samples
 
 try:
     import matplotlib.pyplot as plt
@@ -123,11 +136,10 @@ def generate_corner_plot(sample_files, out, params, truths=None, cutoff=0, frac=
     total_samples = []
     headers = []
     for file in sample_files:
-        samples = np.loadtxt(file, skiprows=1)
+        samples, columns = read_samples(file)
         total_samples.append(samples)
-        with open(file) as f:
-            ### the "header" contains the column names
-            header = f.readline().strip().split(' ')
+        ### the "header" contains the column names (after a "#", as in text files)
+        header = ['#'] + columns
         headers.append(header)
     if combine:
         total_samples.append(np.concatenate(total_samples, axis=0))
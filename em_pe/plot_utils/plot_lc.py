@@ -13,6 +13,7 @@ except:
     import matplotlib.pyplot as plt
 
 from em_pe.models import model_dict
+from em_pe.sample_file import read_samples
 
 def _parse_command_line_args():
     '''
@@ -63,11 +64,8 @@ def generate_lc_plot(out, b, tmin, tmax, m=None, sample_file=None, lc_file=None,
     plt.figure(figsize=(12, 8))
     if m is not None:
         model = model_dict[m]()
-        with open(sample_file) as f:
-            ### the "header" contains the column names
-            header = f.readline().strip().split(' ')
-        samples = np.loadtxt(sample_file)
-        header = header[1:]
+        ### the "header" contains the column names
+        samples, header = read_samples(sample_file)
         lnL = samples[:,0]
         #best_params = samples[np.argmax(lnL)][3:]
         p = samples[:,1]
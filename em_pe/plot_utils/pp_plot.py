@@ -8,6 +8,7 @@ import os
 import json
 
 from em_pe.models import model_dict, param_dict
+from em_pe.sample_file import read_samples
 
 parser = argparse.ArgumentParser(description="Script to generate PP plot")
 parser.add_argument("--m", help="Model to use")
@@ -76,14 +77,11 @@ for d in os.listdir(base_dir):
     if not os.path.isdir(curr_dir) or args.samples_fname not in os.listdir(curr_dir) or curr_dir in exclude_dir or d in exclude_dir:
         continue
     print("reading samples from", curr_dir)
-    s = np.loadtxt(curr_dir + args.samples_fname)
+    s, header = read_samples(curr_dir + args.samples_fname)
     truths = np.loadtxt(curr_dir + "test_truths.txt")
     truths = dict(zip(ordered_params, truths))
     if args.energy:
         truths["energy"] = 0.5 * truths["mej"] * truths["vej"]**2
-    with open(curr_dir + args.samples_fname) as f:
-        ### the "header" contains the column names
-        header = f.readline().strip().split(" ")[1:]
     samples = {header[i]:s[:,i] for i in range(len(header))}
     if args.energy:
         header.append("energy")
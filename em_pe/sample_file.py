@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+Sample file
+-----------
+Reading and writing posterior sample files. Samples are stored either as text
+(one row per sample, with the column names in a "# lnL p p_s ..." header
+line) or in a binary columnar format:
+
+- 8 magic bytes (``EMPESAMP``)
+- the length of the JSON header, as a little-endian 64-bit integer
+- the JSON header, with the column names, number of rows, data type, and any
+  run metadata
+- one contiguous block per column, each starting on a multiple of 64 bytes
+
+Columns of binary files can be memory-mapped, so reading a few columns of a
+large file doesn't require reading the whole file.
+'''
+
+from __future__ import print_function
+import numpy as np
+import json
+import struct
+
+_SAMPLE_MAGIC = b"EMPESAMP"
+_SAMPLE_VERSION = 1
+_SAMPLE_ALIGN = 64
+
+def _align(n):
+    return -(-n // _SAMPLE_ALIGN) * _SAMPLE_ALIGN
+
+def is_binary_sample_file(fname):
+    '''
+    Check whether a file is a binary sample file (rather than text).
+
+    Parameters
+    ----------
+    fname : string
+        File name
+
+    Returns
+    -------
+    bool
+        True if the file starts with the binary format's magic bytes
+    '''
+    with open(fname, "rb") as f:
+        return f.read(len(_SAMPLE_MAGIC)) == _SAMPLE_MAGIC
+
+def write_samples(f, samples, columns, metadata=None, binary=None, float32=False):
+    '''
+    Write posterior samples to a file.
+
+    Parameters
+    ----------
+    f : string or file
+        File name, or file object opened in binary mode
+    samples : np.ndarray
+        2d array with one row per sample
+    columns : list
+        Names of the columns (e.g. ["lnL", "p", "p_s", "mej", ...])
+    metadata : dict
+        JSON-serialisable run information to store in the header (binary
+        format only)
+    binary : bool
+        Use the binary format. By default it's used if the file name ends in
+        ".bin", and text is used otherwise.
+    float32 : bool
+        Store values as 32-bit floats (binary format only)
+    '''
+    if samples.ndim != 2 or samples.shape[1] != len(columns):
+        raise ValueError("samples must have one column per column name")
+    if binary is None:
+        binary = isinstance(f, str) and f.endswith(".bin")
+    if not binary:
+        np.savetxt(f, samples, header=" ".join(columns))
+        return
+    if isinstance(f, str):
+        with open(f, "wb") as fp:
+            write_samples(fp, samples, columns, metadata=metadata, binary=True, float32=float32)
+        return
+    dtype = np.dtype("<f4" if float32 else "<f8")
+    n = samples.shape[0]
+    column_bytes = _align(n * dtype.itemsize)
+    header = json.dumps({"version":_SAMPLE_VERSION, "columns":list(columns), "rows":n,
+                         "dtype":dtype.str, "column_bytes":column_bytes,
+                         "metadata":metadata if metadata is not None else {}}).encode()
+    data_start = _align(len(_SAMPLE_MAGIC) + 8 + len(header))
+    f.write(_SAMPLE_MAGIC)
+    f.write(struct.pack("<q", len(header)))
+    f.write(header)
+    f.write(b"\0" * (data_start - len(_SAMPLE_MAGIC) - 8 - len(header)))
+    padding = b"\0" * (column_bytes - n * dtype.itemsize)
+    for i in range(len(columns)):
+        f.write(np.ascontiguousarray(samples[:,i], dtype=dtype).tobytes())
+        f.write(padding)
+
+class sample_file:
+    '''
+    Read-only view of a binary sample file written by write_samples. Columns
+    are memory-mapped, so data is only read from disk when it's used.
+
+    Parameters
+    ----------
+    fname : string
+        File name
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            if f.read(len(_SAMPLE_MAGIC)) != _SAMPLE_MAGIC:
+                raise ValueError("not a binary sample file: " + fname)
+            (header_length,) = struct.unpack("<q", f.read(8))
+            header = json.loads(f.read(header_length).decode())
+        if header["version"] != _SAMPLE_VERSION:
+            raise ValueError("unsupported sample file version: " + str(header["version"]))
+        self.columns = header["columns"]
+        self.n_rows = header["rows"]
+        self.dtype = np.dtype(header["dtype"])
+        self.metadata = header["metadata"]
+        self.column_bytes = header["column_bytes"]
+        self.data_start = _align(len(_SAMPLE_MAGIC) + 8 + header_length)
+        self.mm = np.memmap(fname, dtype=np.uint8, mode="r") if self.n_rows > 0 else None
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        '''
+        Get one column.
+
+        Parameters
+        ----------
+        name : string
+            Column name
+
+        Returns
+        -------
+        np.ndarray
+            1d (read-only) view of the memory-mapped column
+        '''
+        if self.mm is None:
+            return np.empty(0, dtype=self.dtype)
+        start = self.data_start + self.columns.index(name) * self.column_bytes
+        return self.mm[start:start + self.n_rows * self.dtype.itemsize].view(self.dtype)
+
+    def array(self, columns=None):
+        '''
+        Read several columns into a 2d array.
+
+        Parameters
+        ----------
+        columns : list
+            Names of the columns to read (default: all of them)
+
+        Returns
+        -------
+        np.ndarray
+            2d float64 array with one row per sample
+        '''
+        if columns is None:
+            columns = self.columns
+        ret = np.empty((self.n_rows, len(columns)))
+        for i, name in enumerate(columns):
+            ret[:,i] = self.column(name)
+        return ret
+
+def read_samples(fname, columns=None):
+    '''
+    Read posterior samples from a text or binary sample file (the format is
+    detected from the file's contents).
+
+    Parameters
+    ----------
+    fname : string
+        File name
+    columns : list
+        Names of the columns to read (default: all of them)
+
+    Returns
+    -------
+    (np.ndarray, list)
+        2d array with one row per sample, and the names of its columns
+    '''
+    if is_binary_sample_file(fname):
+        f = sample_file(fname)
+        if columns is None:
+            columns = f.columns
+        return f.array(columns), list(columns)
+    with open(fname) as f:
+        ### the header contains the column names, after a "# "
+        header = f.readline().strip().split(" ")[1:]
+    samples = np.atleast_2d(np.loadtxt(fname))
+    if columns is None:
+        return samples, header
+    return samples[:,[header.index(name) for name in columns]], list(columns)
@@ -4,17 +4,90 @@ from __future__ import print_function
 import numpy as np
 import argparse
 import sys
-from multiprocessing import Pool
+import os
+import pickle
+import copy
+import hashlib
+import threading
+import queue
+from multiprocessing import Pool, util
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # python < 3.8
+    shared_memory = None
 
 ### hacky fix because the import system is different when run as a package vs.
 ### run as a script
 try:
     from models import model_dict, param_dict
+    from models.surrogate import get_surrogate_cache, set_surrogate_cache_mb
+    from sample_file import write_samples
 except ModuleNotFoundError:
     from .models import model_dict, param_dict
+    from .models.surrogate import get_surrogate_cache, set_surrogate_cache_mb
+    from .sample_file import write_samples
 
 import RIFT.integrators.MonteCarloEnsemble as monte_carlo_integrator
 
+### state held by each process of the likelihood worker pool
+_worker_sampler = None
+_worker_model = None
+_worker_buffers = {} # shared-memory blocks this worker has attached to, by name
+_parent_model = None # the parent's model, inherited by workers started by fork
+
+def _initialize_worker(s):
+    '''
+    Initializer for the likelihood worker pool. Stores the sampler (which holds
+    the data and parameter information) and the model, once for the lifetime
+    of the pool. If the worker was forked from the parent, it uses the
+    parent's model, so large read-only data (e.g. surrogates) loaded by the
+    model is shared copy-on-write rather than loaded again by every worker.
+    Otherwise (e.g. with the spawn start method) it builds its own model.
+    '''
+    global _worker_sampler, _worker_model
+    _worker_sampler = s
+    if s.surrogate_cache_mb is not None:
+        set_surrogate_cache_mb(s.surrogate_cache_mb)
+    if s.v:
+        ### report this worker's surrogate cache use when the pool is shut down
+        util.Finalize(None, _report_surrogate_cache, args=('worker ' + str(os.getpid()) + ' ',), exitpriority=10)
+    if _parent_model is not None:
+        _worker_model = _parent_model
+        return
+    _worker_model = s._build_model()
+
+def _report_surrogate_cache(prefix=''):
+    ### print the surrogate cache hits and misses of this process (if the model used it)
+    cache = get_surrogate_cache()
+    if cache.hits + cache.misses > 0:
+        print(prefix + 'surrogate cache:', cache.hits, 'hits,', cache.misses, 'misses,', len(cache), 'surrogates loaded')
+        sys.stdout.flush()
+
+def _evaluate_worker(samples):
+    '''
+    Evaluates lnL for a chunk of samples inside a worker process.
+    '''
+    return _worker_sampler._integrand_subprocess((_worker_model, samples))
+
+def _evaluate_worker_shared(arg):
+    '''
+    Evaluates lnL for rows start:stop of the shared-memory sample buffer inside
+    a worker process, writing the results in place in the shared lnL buffer.
+    '''
+    samples_name, lnL_name, n, d, start, stop = arg
+    ### attach to the parent's blocks, dropping any that the parent has since replaced
+    for name in list(_worker_buffers.keys()):
+        if name not in (samples_name, lnL_name):
+            _worker_buffers.pop(name).close()
+    for name in (samples_name, lnL_name):
+        if name not in _worker_buffers:
+            _worker_buffers[name] = shared_memory.SharedMemory(name=name)
+            ### the parent owns (and unlinks) the block, so don't let this process clean it up on exit
+            resource_tracker.unregister(_worker_buffers[name]._name, 'shared_memory')
+    samples = np.ndarray((n, d), buffer=_worker_buffers[samples_name].buf)
+    lnL = np.ndarray((n,), buffer=_worker_buffers[lnL_name].buf)
+    lnL[start:stop] = _worker_sampler._integrand_subprocess((_worker_model, samples[start:stop]))
+
 def _parse_command_line_args():
     '''
     Parses and returns the command line arguments.
@@ -27,7 +100,10 @@ def _parse_command_line_args():
     parser.add_argument('--f', action='append', help='Name of a data file')
     parser.add_argument('--min', default=20, type=int, help='Minimum number of integrator iterations')
     parser.add_argument('--max', default=20, type=int, help='Maximum number of integrator iterations')
-    parser.add_argument('--out', help='Location to store posterior samples')
+    parser.add_argument('--out', help='Location to store posterior samples (in binary format if the name ends in .bin, otherwise as text)')
+    parser.add_argument('--float32', action='store_true', help='Store posterior samples as 32-bit floats (binary output only)')
+    parser.add_argument('--checkpoint-every', type=int, default=0, help='Save a checkpoint every n iterations, so the run can be resumed (default: no checkpoints)')
+    parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint, if there is one')
     parser.add_argument('--ncomp', action='append', nargs=2, help='Number of Gaussian components for a given dimension')
     parser.add_argument('--fixed-param', action='append', nargs=2, help='Parameters with fixed values')
     parser.add_argument('--estimate-dist', action="store_true", help='Estimate distance')
@@ -40,9 +116,295 @@ def _parse_command_line_args():
     parser.add_argument('--nprocs', type=int, default=1, help='Number of parallel processes to use for likelihood evaluation')
     parser.add_argument('--set-limit', action='append', nargs=3, help='Modify parameter limits (e.g. --set-limit mej_red 0.008 0.012)')
     parser.add_argument('--ignore-model-error', action='store_true', help='Fix model error to 0 (i.e. ignore it)')
+    parser.add_argument('--shared-memory', action='store_true', help='Pass samples and lnL values to worker processes through shared memory (requires --nprocs > 1)')
+    parser.add_argument('--model-memory-mb', type=float, help='Approximate memory (in MB) for the model to use for temporary arrays when evaluating a batch of samples (default: $EM_PE_MODEL_MEMORY_MB, or 256)')
+    parser.add_argument('--kn-interp-step', type=int, help='Use every n-th time-step interpolator of the kn_interp model (default: $EM_PE_KN_INTERP_STEP, or 4)')
+    parser.add_argument('--surrogate-cache-mb', type=float, help='Memory (in MB, per process) to keep loaded surrogates in (default: $EM_PE_SURROGATE_CACHE_MB, or 1024)')
     parser.add_argument('--gaussian-prior-theta', nargs=2, type=float, help='Mean and std. dev. for Gaussian prior (overrides default uniform prior for angle')
     return parser.parse_args()
 
+class sample_store:
+    '''
+    Growable columnar array of samples. Storage is allocated with spare
+    capacity, which is doubled whenever it runs out, so appending a batch
+    only copies the new rows (amortised). Each column is contiguous.
+
+    Parameters
+    ----------
+    columns : list
+        Names of the columns
+    capacity : int
+        Number of rows to allocate initially
+    '''
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self.data = np.empty((max(int(capacity), 1), len(self.columns)), order='F')
+        self.size = 0
+        self.starts = [] # first row of each appended batch
+        self.n_batches = 0 # number of batches appended
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        ### only the rows in use are saved, not the spare capacity
+        state = self.__dict__.copy()
+        state['data'] = self.data[:self.size]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.asfortranarray(self.data)
+
+    def reserve(self, capacity):
+        '''
+        Make sure there is room for at least capacity rows.
+
+        Parameters
+        ----------
+        capacity : int
+            Number of rows needed
+        '''
+        if capacity <= self.data.shape[0]:
+            return
+        new_capacity = max(self.data.shape[0], 1)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        data = np.empty((new_capacity, len(self.columns)), order='F')
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    def append(self, *blocks):
+        '''
+        Append a batch of rows.
+
+        Parameters
+        ----------
+        blocks : np.ndarray
+            Arrays with one row per sample, holding consecutive columns (a 1d
+            array is a single column)
+        '''
+        blocks = [b if np.ndim(b) == 2 else np.reshape(b, (-1, 1)) for b in blocks]
+        n = blocks[0].shape[0] if len(blocks) > 0 else 0
+        if sum(b.shape[1] for b in blocks) != len(self.columns) or any(b.shape[0] != n for b in blocks):
+            raise ValueError("Blocks don't match the store's columns")
+        self.reserve(self.size + n)
+        col = 0
+        for b in blocks:
+            self.data[self.size:self.size + n, col:col + b.shape[1]] = b
+            col += b.shape[1]
+        self.starts.append(self.size)
+        self.size += n
+        self.n_batches += 1
+
+    def all(self):
+        '''
+        View of every row stored so far (not a copy).
+
+        Returns
+        -------
+        np.ndarray
+            2d array with one column per entry of self.columns
+        '''
+        return self.data[:self.size]
+
+    def latest(self):
+        '''
+        View of the rows from the most recent append (not a copy).
+
+        Returns
+        -------
+        np.ndarray
+            2d array with one column per entry of self.columns
+        '''
+        start = self.starts[-1] if len(self.starts) > 0 else 0
+        return self.data[start:self.size]
+
+    def column(self, name):
+        '''
+        View of a single (contiguous) column.
+
+        Parameters
+        ----------
+        name : string
+            Name of the column
+
+        Returns
+        -------
+        np.ndarray
+            1d array of the column's values
+        '''
+        return self.data[:self.size, self.columns.index(name)]
+
+    def keep_largest(self, name, k):
+        '''
+        Drop all but the k rows with the largest values in a column, keeping
+        the remaining rows in order. Ties are broken in favour of later rows,
+        so the rows kept are the last k of a stable sort by the column. The
+        rows are copied to new storage, so existing views aren't modified.
+
+        Parameters
+        ----------
+        name : string
+            Name of the column
+        k : int
+            Number of rows to keep
+        '''
+        if self.size <= k:
+            return
+        values = self.column(name)
+        if k > 0:
+            ### the k-th largest value: keep everything above it, and as many of the latest rows equal to it as needed
+            threshold = np.partition(values, self.size - k)[self.size - k]
+            keep = values > threshold
+            ties = np.flatnonzero(values == threshold)
+            keep[ties[ties.size - (k - np.count_nonzero(keep)):]] = True
+        else:
+            keep = np.zeros(self.size, dtype=bool)
+        data = np.empty_like(self.data)
+        data[:k] = self.data[:self.size][keep]
+        self.data = data
+        self.size = k
+        self.starts = [0]
+
+class sample_writer:
+    '''
+    Writes blocks of samples to files (see write_samples) on a background
+    thread, so that formatting and disk writes overlap with the caller's work.
+    Each file is flushed to disk (fsync) before the next one is started.
+
+    Parameters
+    ----------
+    columns : list
+        Names of the columns
+    float32 : bool
+        Store values as 32-bit floats (binary files only)
+    '''
+    def __init__(self, columns, float32=False):
+        self.columns = columns
+        self.float32 = float32
+        self.queue = queue.Queue()
+        self.error = None # first exception raised by the writer thread
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fname, samples = item
+            try:
+                with open(fname, 'wb') as f:
+                    write_samples(f, samples, self.columns, binary=fname.endswith('.bin'), float32=self.float32)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, fname, samples):
+        '''
+        Queue a block of samples to be written.
+
+        Parameters
+        ----------
+        fname : string
+            File to write
+        samples : np.ndarray
+            2d array of samples. It's written after this returns, so it must
+            not be modified afterwards (rows in a sample_store never are).
+        '''
+        self._check()
+        self.queue.put((fname, samples))
+
+    def flush(self):
+        '''
+        Wait for every queued block to be written (and flushed to disk).
+        '''
+        if self.thread.is_alive():
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        '''
+        Wait for every queued block to be written, then stop the thread.
+        '''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+class likelihood:
+    '''
+    Gaussian log-likelihood of lightcurve data. The data-derived arrays and
+    constants for each band are computed once, when the object is created.
+
+    Parameters
+    ----------
+    data : dict
+        Dictionary mapping band names to data arrays (columns are time, unused,
+        magnitude, and magnitude error)
+    bands : list
+        Bands to include in the likelihood
+    ignore_m_err : bool
+        Fix model error to 0 (i.e. ignore it)
+    '''
+    def __init__(self, data, bands, ignore_m_err=False):
+        self.bands = bands
+        self.ignore_m_err = ignore_m_err
+        self.t = {} # observation times
+        self.x = {} # observed magnitudes
+        self.var = {} # squared data errors
+        self.inv_var = {}
+        self.log_det = 0.0 # sum of log(2 pi var) over all data points
+        for band in bands:
+            self.t[band] = np.ascontiguousarray(data[band][:,0])
+            self.x[band] = np.ascontiguousarray(data[band][:,2])
+            self.var[band] = np.ascontiguousarray(data[band][:,3])**2
+            self.inv_var[band] = 1.0 / self.var[band]
+            self.log_det += np.sum(np.log(2.0 * np.pi * self.var[band]))
+
+    def __call__(self, model_data):
+        '''
+        Evaluate the log-likelihood.
+
+        Parameters
+        ----------
+        model_data : dict
+            Dictionary mapping band names to [m, m_err] pairs. These can either
+            be 1d arrays (one sample) or 2d arrays with one row per sample.
+
+        Returns
+        -------
+        float or np.ndarray
+            lnL (an array with one value per row if 2d arrays were passed)
+        '''
+        if self.ignore_m_err:
+            ### the variance doesn't depend on the model, so this is just a
+            ### weighted sum of squares plus a constant
+            ret = self.log_det
+            for band in self.bands:
+                diff = self.x[band] - model_data[band][0]
+                ret = ret + np.sum(diff**2 * self.inv_var[band], axis=-1)
+            return -0.5 * ret
+        ret = 0.0
+        for band in self.bands:
+            m, m_err = model_data[band]
+            var = self.var[band] + m_err**2
+            diff = self.x[band] - m
+            ret = ret + np.sum(diff**2 / var + np.log(2.0 * np.pi * var), axis=-1)
+        return -0.5 * ret
+
 class sampler:
     '''
     Generate posterior samples. This is the function called when using CLI.
@@ -67,11 +429,34 @@ class sampler:
         Number of Gaussian components to use for integrator
     fixed_params : list
         List of [param_name, value] pairs
+    shared_mem : bool
+        Pass samples and lnL values to worker processes through shared memory
+        instead of pickling them (only used if nprocs > 1)
+    float32 : bool
+        Store samples as 32-bit floats (only used for binary output, i.e. if
+        out ends in ".bin")
+    checkpoint_every : int
+        Save the state of the run every checkpoint_every iterations (0 to
+        disable), so it can be resumed
+    resume : bool
+        Continue from the last checkpoint, if there is one
+    surrogate_cache_mb : float
+        Memory budget (in MB, per process) for loaded surrogates (default: the
+        EM_PE_SURROGATE_CACHE_MB environment variable, or 1024)
+    kn_interp_step : int
+        Use every kn_interp_step-th time-step interpolator (kn_interp model
+        only; default: the EM_PE_KN_INTERP_STEP environment variable, or 4)
+    model_memory_mb : float
+        Approximate memory (in MB) for the model to use for temporary arrays
+        when evaluating a batch of samples (default: the EM_PE_MODEL_MEMORY_MB
+        environment variable, or 256)
     '''
     def __init__(self, data_loc, m, files, out, v=True, L_cutoff=0, min_iter=20,
                  max_iter=20, ncomp=None, fixed_params=None,
                  estimate_dist=True, epoch=5, correlate_dims=None, burn_in_length=None,
-                 beta_start=1.0, beta_end=1.0, keep_npts=None, nprocs=1, limits=None, ignore_m_err=False, gaussian_prior_theta=None):
+                 beta_start=1.0, beta_end=1.0, keep_npts=None, nprocs=1, limits=None, ignore_m_err=False, gaussian_prior_theta=None,
+                 shared_mem=False, float32=False, checkpoint_every=0, resume=False, surrogate_cache_mb=None,
+                 kn_interp_step=None, model_memory_mb=None):
         ### parameters passed in from user or main()
         self.data_loc = data_loc
         self.m = m
@@ -94,6 +479,16 @@ class sampler:
         self.nprocs = nprocs
         self.ignore_m_err = ignore_m_err
         self.gaussian_prior_theta = gaussian_prior_theta
+        self.shared_mem = shared_mem
+        self.float32 = float32
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.surrogate_cache_mb = surrogate_cache_mb
+        if kn_interp_step is not None and m != "kn_interp":
+            raise ValueError("kn_interp_step is only used by the kn_interp model")
+        self.kn_interp_step = kn_interp_step
+        self.model_memory_mb = model_memory_mb
+        self.checkpoint_fname = os.path.splitext(out)[0] + "_checkpoint.pkl"
         self.limits = limits if limits is not None else {}
         if ncomp is None:
             self.ncomp = 1
@@ -107,20 +502,26 @@ class sampler:
 
         ###variables to store
         self.integrator = None
+        self.pool = None
+        self.shm_samples = None # shared-memory sample and lnL buffers (if shared_mem is True)
+        self.shm_lnL = None
         self.data = None
         self.bands_used = None
-        self.models = []
+        self.model = None
         self.params = None
         self.ordered_params = None
         self.bounds = None
         self.t_bounds = None
+        self.likelihood = None
         self.iteration = 0
         self.iteration_size = 0
-
-        self.cumulative_lnL = np.array([])
+        self.store = None # sample_store of lnL, p, p_s and parameter values
+        self.iteration_lnL = None # lnL values from the current iteration
+        self.writer = None # sample_writer for the intermediate samples
 
         ### initialization things
         self._read_data()
+        self.likelihood = likelihood(self.data, self.bands_used, self.ignore_m_err)
         self._initialize_model()
 
     def _read_data(self):
@@ -140,21 +541,22 @@ class sampler:
     def _initialize_model(self):
         if self.v:
             print('Initializing models... ', end='')
-        ### initialize model objects (one for each parallel process)
-        for i in range(self.nprocs):
-            model = model_dict[self.m]()
-            self.models.append(model)
-            ordered_params = [] # keep track of all parameters used
-            bounds = [] # bounds for each parameter
-            params = {}
-            for param in model.param_names:
-                if param not in ordered_params and param not in self.fixed_params:
-                    ordered_params.append(param)
-                    params[param] = param_dict[param]()
-                    if param in self.limits.keys():
-                        llim, rlim = self.limits[param]
-                        params[param].update_limits(llim, rlim)
-                    bounds.append([params[param].llim, params[param].rlim])
+        if self.surrogate_cache_mb is not None:
+            set_surrogate_cache_mb(self.surrogate_cache_mb)
+        ### initialize the model object (worker processes build their own copies, see _initialize_pool)
+        model = self._build_model()
+        self.model = model
+        ordered_params = [] # keep track of all parameters used
+        bounds = [] # bounds for each parameter
+        params = {}
+        for param in model.param_names:
+            if param not in ordered_params and param not in self.fixed_params:
+                ordered_params.append(param)
+                params[param] = param_dict[param]()
+                if param in self.limits.keys():
+                    llim, rlim = self.limits[param]
+                    params[param].update_limits(llim, rlim)
+                bounds.append([params[param].llim, params[param].rlim])
         t_bounds = [np.inf, -1 * np.inf] # tmin and tmax for each band
         for band in self.bands_used:
             t = self.data[band][0]
@@ -171,6 +573,97 @@ class sampler:
         if self.v:
             print('finished')
 
+    def _build_model(self):
+        ### make a model object set up for this run (also used by worker processes that don't share the parent's)
+        kwargs = {}
+        if self.kn_interp_step is not None:
+            kwargs['step'] = self.kn_interp_step
+        model = model_dict[self.m](**kwargs)
+        if self.model_memory_mb is not None:
+            model.memory_mb = float(self.model_memory_mb)
+        ### the model error is multiplied by zero when it's ignored, so the model doesn't need to compute it
+        model.model_error = not self.ignore_m_err
+        model.set_obs_times(self.likelihood.t)
+        return model
+
+    def __getstate__(self):
+        ### only the data and parameter information are needed by the worker
+        ### processes, so leave out the pool, models, and integrator state
+        state = self.__dict__.copy()
+        for key in ['pool', 'shm_samples', 'shm_lnL', 'model', 'integrator', 'store', 'iteration_lnL', 'writer']:
+            state[key] = None
+        return state
+
+    def _initialize_pool(self):
+        ### start the worker processes once; each one keeps the model (see
+        ### _initialize_worker) and the data for the lifetime of the pool
+        global _parent_model
+        if self.v:
+            print('Starting', self.nprocs, 'worker processes')
+        _parent_model = self.model
+        ### the workers get a copy without the pool (see __getstate__), so the pool doesn't keep this sampler alive
+        self.pool = Pool(self.nprocs, initializer=_initialize_worker, initargs=(copy.copy(self),))
+
+    def _allocate_shared_buffers(self, n, d):
+        ### make sure the shared-memory buffers can hold n samples of dimension d,
+        ### replacing them with larger ones if necessary
+        if shared_memory is None:
+            raise RuntimeError("Shared memory transport requires Python 3.8 or newer")
+        if self.shm_lnL is not None and self.shm_samples.size >= n * d * 8 and self.shm_lnL.size >= n * 8:
+            return
+        self._free_shared_buffers()
+        self.shm_samples = shared_memory.SharedMemory(create=True, size=max(n * d, 1) * 8)
+        self.shm_lnL = shared_memory.SharedMemory(create=True, size=max(n, 1) * 8)
+
+    def _free_shared_buffers(self):
+        for shm in [self.shm_samples, self.shm_lnL]:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shm_samples = None
+        self.shm_lnL = None
+
+    def _evaluate_shared(self, samples):
+        ### copy the samples into shared memory once; the workers only receive
+        ### row offsets, and write their lnL values in place
+        n, d = samples.shape
+        self._allocate_shared_buffers(n, d)
+        np.ndarray((n, d), buffer=self.shm_samples.buf)[:] = samples
+        splits = np.linspace(0, n, self.nprocs + 1).astype(int)
+        args = [(self.shm_samples.name, self.shm_lnL.name, n, d, splits[i], splits[i + 1]) for i in range(self.nprocs)]
+        self.pool.map(_evaluate_worker_shared, args)
+        return np.ndarray((n,), buffer=self.shm_lnL.buf).copy()
+
+    def close(self):
+        '''
+        Shut down the likelihood worker pool (if there is one), release any
+        shared memory, and finish writing the intermediate samples. This is
+        done by generate_samples; when calling log_likelihood directly, call
+        close afterwards (or use the sampler as a context manager).
+        '''
+        global _parent_model
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if _parent_model is self.model:
+            _parent_model = None
+        self._free_shared_buffers()
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        ### last resort for a pool started by log_likelihood, so its worker processes don't outlive the sampler
+        if getattr(self, "pool", None) is not None:
+            self.close()
+
     def _prior(self, sample_array):
         n, m = sample_array.shape
         ret = np.ones(n)
@@ -189,57 +682,118 @@ class sampler:
         temp_data = {} # used to hold model data and squared model error
         for band in self.bands_used:
             temp_data[band] = [None, None]
-        ### evaluate each model for the params, in the required bands
+        ### evaluate the model for the params, in all the required bands at once
         model.set_params(params, self.t_bounds)
-        for band in model.bands:
-            if band not in self.bands_used:
-                continue
-            t = self.data[band][:,0]
-            m, m_err = model.evaluate(t, band)
+        obs_times = {band:self.likelihood.t[band] for band in model.bands if band in self.bands_used}
+        for band, (m, m_err) in model.evaluate_bands(obs_times).items():
             temp_data[band][0] = m
             temp_data[band][1] = m_err
             if 'dist' in params:
                 dist = params['dist']
                 if vectorized:
-                    for i in range(dist.size):
-                        temp_data[band][0][i] += 5.0 * (np.log10(dist[i] * 1.0e6) - 1.0)
+                    ### one distance modulus per sample (row)
+                    temp_data[band][0] = m + (5.0 * (np.log10(dist * 1.0e6) - 1.0)).reshape((-1, 1))
                 else:
                     temp_data[band][0] += 5.0 * (np.log10(dist * 1.0e6) - 1.0)
+            if vectorized:
+                ### make sure both are 2d, with one row per sample
+                temp_data[band][0] = np.atleast_2d(temp_data[band][0])
+                temp_data[band][1] = np.atleast_2d(m_err)
 
-        if vectorized:
-            for band in self.bands_used:
-                x = self.data[band][:,2]
-                err = self.data[band][:,3]
-                m = temp_data[band][0]
-                m_err = temp_data[band][1]
-                if self.ignore_m_err:
-                    m_err *= 0.0
-                lnL = np.zeros(m.shape[0])
-                for i in range(m.shape[0]):
-                    diff = x - m[i]
-                    lnL[i] += np.sum(diff**2 / (err**2 + m_err[i]**2) + np.log(2.0 * np.pi * (err**2 + m_err[i]**2)))
-            return -0.5 * lnL
-
-        lnL = 0
-        ### calculate lnL
-        for band in self.bands_used:
-            x = self.data[band][:,2]
-            err = self.data[band][:,3]
-            m = temp_data[band][0]
-            m_err = temp_data[band][1]
-            if self.ignore_m_err:
-                m_err *= 0.0
-            diff = x - m
-            lnL += np.sum(diff**2 / (err**2 + m_err**2) + np.log(2.0 * np.pi * (err**2 + m_err**2)))
-        return -0.5 * lnL
+        return self.likelihood(temp_data)
+
+    def _record_iteration(self, integrator):
+        ### called by the integrator after each iteration: add the iteration's
+        ### samples to the store, keeping the same ones the integrator does
+        sys.stdout.flush()
+        mask = (np.exp(integrator.value_array) >= integrator.L_cutoff).flatten()
+        ### with keep_npts, only the top keep_npts samples from previous iterations are needed
+        if self.keep_npts is not None:
+            self.store.keep_largest('lnL', self.keep_npts)
+        self.store.append(self.iteration_lnL[mask], integrator.prior_array[mask],
+                integrator.p_array[mask], integrator.sample_array[mask])
+        ### the integrator also keeps every sample, but only uses them to print
+        ### the highest lnL so far, so keep just that one
+        if integrator.cumulative_values.shape[0] > 1:
+            i = np.argmax(integrator.cumulative_values)
+            for key in ['cumulative_samples', 'cumulative_values', 'cumulative_p', 'cumulative_p_s']:
+                setattr(integrator, key, getattr(integrator, key)[i:i + 1])
+        if self.checkpoint_every > 0 and integrator.iterations % self.checkpoint_every == 0:
+            self._save_checkpoint()
+
+    def _run_settings(self):
+        ### everything that has to be the same for a checkpoint to be resumed: the model, data, parameters,
+        ### and sampling settings (but not e.g. the number of iterations or processes)
+        return {'m':self.m,
+                'kn_interp_step':self.kn_interp_step,
+                'files':list(self.files),
+                'data':{band:hashlib.sha1(np.ascontiguousarray(d).tobytes()).hexdigest() for band, d in self.data.items()},
+                'ordered_params':list(self.ordered_params),
+                'fixed_params':dict(self.fixed_params),
+                'limits':{name:tuple(lims) for name, lims in self.limits.items()},
+                'gaussian_prior_theta':self.gaussian_prior_theta,
+                'ignore_m_err':self.ignore_m_err,
+                'L_cutoff':self.L_cutoff,
+                'keep_npts':self.keep_npts,
+                'epoch':self.epoch,
+                'ncomp':self.ncomp,
+                'correlate_dims':self.correlate_dims,
+                'burn_in_length':self.burn_in_length,
+                'beta_start':self.beta_start,
+                'beta_end':self.beta_end}
+
+    def _save_checkpoint(self):
+        ### save everything needed to continue the run from the next iteration:
+        ### the integrator (including its sampling distributions), the samples,
+        ### the iteration counter (which sets the burn-in beta), and the RNG state
+        ### the checkpoint marks every iteration so far as done, so the intermediate samples queued so far have to
+        ### be on disk first (a resumed run doesn't write them again)
+        if self.writer is not None:
+            self.writer.flush()
+        integrator_state = self.integrator.__dict__.copy()
+        for key in ['prior', 'user_func']:
+            del integrator_state[key]
+        state = {'settings':self._run_settings(),
+                 'iteration':self.iteration,
+                 'iteration_size':self.iteration_size,
+                 'store':self.store,
+                 'integrator':integrator_state,
+                 'random_state':np.random.get_state()}
+        if self.v:
+            print('saving checkpoint to', self.checkpoint_fname)
+        ### write to a temporary file first, so an interruption never leaves a partial checkpoint
+        tmp_fname = self.checkpoint_fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self.checkpoint_fname)
+
+    def _load_checkpoint(self):
+        ### restore the state saved by _save_checkpoint (after the integrator and
+        ### store have been created)
+        with open(self.checkpoint_fname, 'rb') as f:
+            state = pickle.load(f)
+        settings = self._run_settings()
+        different = [key for key in settings if state['settings'].get(key) != settings[key]]
+        if len(different) > 0:
+            raise RuntimeError("Checkpoint " + self.checkpoint_fname + " is from a run with different settings ("
+                    + ", ".join(different) + "); remove it or use the same settings to resume")
+        if self.v:
+            print('resuming from', self.checkpoint_fname, 'after iteration', state['iteration'])
+        self.iteration = state['iteration']
+        self.iteration_size = state['iteration_size']
+        self.store = state['store']
+        self.integrator.__dict__.update(state['integrator'])
+        ### the checkpoint is saved before the integrator resets its sampling distributions at the end of an epoch
+        if self.epoch is not None and self.integrator.iterations % self.epoch == 0:
+            self.integrator._reset()
+        np.random.set_state(state['random_state'])
 
     def _get_current_samples(self):
-        samples = np.copy(self.cumulative_lnL).reshape((self.cumulative_lnL.size, 1))
-        samples = np.append(samples, self.integrator.cumulative_p, axis=1)
-        samples = np.append(samples, self.integrator.cumulative_p_s, axis=1)
-        samples = np.append(samples, self.integrator.cumulative_samples, axis=1)
+        samples = self.store.all()
         if self.keep_npts is not None and self.keep_npts < samples.shape[0]:
-            ind_sorted = np.argsort(samples[:,0])
+            ind_sorted = np.argsort(samples[:,0], kind='stable')
             samples = samples[ind_sorted[samples.shape[0] - self.keep_npts:]]
         return samples
 
@@ -269,11 +823,20 @@ class sampler:
         if self.v:
             print("Iteration", self.iteration)
         if self.iteration > 0:
-            header = 'lnL p p_s ' + ' '.join(self.ordered_params)
             if self.v:
                 print("saving intermediate samples...")
-            fname = self.out.split(".")[0] + "_intermediate" + str(self.iteration) + "." + "".join(self.out.split(".")[1:])
-            np.savetxt(fname, self._get_current_samples()[-self.iteration_size:], header=header)
+            base, ext = os.path.splitext(self.out)
+            fname = base + "_intermediate" + str(self.iteration) + ext
+            ### the worker pool (if any) has already been started, so it isn't forked while this thread is running
+            if self.writer is None:
+                self.writer = sample_writer(self.store.columns, float32=self.float32)
+            ### with keep_npts, save the highest-lnL samples so far (as many as the last iteration had),
+            ### otherwise the last iteration's samples
+            if self.keep_npts is not None:
+                intermediate = self._get_current_samples()[-self.iteration_size:]
+            else:
+                intermediate = self.store.latest()
+            self.writer.write(fname, intermediate)
         if self.burn_in_length is not None and self.iteration < self.burn_in_length:
             beta = np.exp((1.0 - self.iteration / (self.burn_in_length + 1.0)) * np.log(self.beta_start)
                     + self.iteration * np.log(self.beta_end) / (self.burn_in_length + 1.0)) # evenly-spaced on log scale
@@ -282,19 +845,21 @@ class sampler:
         n, _ = samples.shape
         self.iteration_size = n
         if self.nprocs == 1:
-            ret = self._integrand_subprocess((self.models[0], samples))
+            ret = self._integrand_subprocess((self.model, samples))
         elif self.nprocs > 1:
-            samples_split = np.array_split(samples, self.nprocs)
-            args = zip(self.models, samples_split)
-            with Pool(self.nprocs) as p:
-                ret = np.concatenate(p.map(self._integrand_subprocess, args))
+            if self.pool is None:
+                self._initialize_pool()
+            if self.shared_mem:
+                ret = self._evaluate_shared(samples)
+            else:
+                ret = np.concatenate(self.pool.map(_evaluate_worker, np.array_split(samples, self.nprocs)))
         else:
             raise RuntimeError("nprocs < 1: How can you have less than 1 process?")
         ret = ret.reshape((n, 1))
         #print(np.min(ret), np.max(ret))
         ret[np.isnan(ret)] = -1 * np.inf
         self.iteration += 1
-        self.cumulative_lnL = np.append(self.cumulative_lnL, ret)
+        self.iteration_lnL = ret.copy()
         ret *= beta
         if self.v:
             print("points with non-zero likelihood:", np.sum(np.exp(ret - np.max(ret)) > 0.0))
@@ -335,9 +900,22 @@ class sampler:
         ### initialize and run the integrator
         self.integrator = monte_carlo_integrator.integrator(dim, self.bounds, gmm_dict, ncomp,
                         proc_count=None, L_cutoff=self.L_cutoff, use_lnL=True,
-                        user_func=sys.stdout.flush(), prior=self._prior)
+                        user_func=self._record_iteration, prior=self._prior)
+        self.store = sample_store(['lnL', 'p', 'p_s'] + self.ordered_params, capacity=self.integrator.n)
+        ### start the worker processes before anything else (e.g. the intermediate sample writer's thread)
+        ### is running, and before a checkpoint's samples are loaded into the parent
+        if self.nprocs > 1 and self.pool is None:
+            self._initialize_pool()
+        if self.resume:
+            if os.path.exists(self.checkpoint_fname):
+                self._load_checkpoint()
+            elif self.v:
+                print('no checkpoint found at', self.checkpoint_fname + ', starting from the beginning')
         self.integrator.integrate(self._integrand, min_iter=self.min_iter, max_iter=self.max_iter, 
                 progress=self.v, epoch=self.epoch)
+        ### the integrator skips user_func if it stops early in an iteration
+        if self.store.n_batches < self.integrator.iterations:
+            self._record_iteration(self.integrator)
         ### make the array of samples
         if self.v:
             print('Integral result:', self.integrator.integral)
@@ -347,13 +925,29 @@ class sampler:
         '''
         Generate posterior samples.
         '''
-        samples = self._generate_samples()
-        header = 'lnL p p_s ' + ' '.join(self.ordered_params)
-        np.savetxt(self.out, samples, header=header)
+        try:
+            samples = self._generate_samples()
+        finally:
+            self.close()
+        if self.v:
+            _report_surrogate_cache()
+        metadata = {'model':self.m, 'bands':self.bands_used, 'fixed_params':self.fixed_params,
+                    'integral':float(self.integrator.integral), 'eff_samp':float(self.integrator.eff_samp),
+                    'iterations':int(self.integrator.iterations), 'keep_npts':self.keep_npts}
+        write_samples(self.out, samples, self.store.columns, metadata=metadata, float32=self.float32)
+        ### the run is finished, so the checkpoint would only be a stale state to resume from
+        if (self.checkpoint_every > 0 or self.resume) and os.path.exists(self.checkpoint_fname):
+            os.remove(self.checkpoint_fname)
 
     def log_likelihood(self, samples, vect=False):
         '''
-        Function to calculate log-likelihoods of parameter samples
+        Function to calculate log-likelihoods of parameter samples. If nprocs
+        is greater than 1, this starts the worker processes, which are only
+        shut down by close(), so either call close() when done or use the
+        sampler in a with statement, e.g.
+
+            with sampler(...) as s:
+                lnL = s.log_likelihood(samples, vect=True)
 
         Parameters
         ----------
@@ -415,7 +1009,10 @@ def main():
         limits = None
     s = sampler(data_loc, m, files, out, v=v, L_cutoff=L_cutoff, min_iter=min_iter, max_iter=max_iter, ncomp=ncomp, 
             fixed_params=fixed_params, estimate_dist=estimate_dist, epoch=epoch, correlate_dims=correlate_dims,
-            burn_in_length=burn_in_length, beta_start=beta_start, beta_end=beta_end, keep_npts=keep_npts, nprocs=nprocs, limits=limits, ignore_m_err=args.ignore_model_error, gaussian_prior_theta=args.gaussian_prior_theta)
+            burn_in_length=burn_in_length, beta_start=beta_start, beta_end=beta_end, keep_npts=keep_npts, nprocs=nprocs, limits=limits, ignore_m_err=args.ignore_model_error, gaussian_prior_theta=args.gaussian_prior_theta,
+            shared_mem=args.shared_memory, float32=args.float32, checkpoint_every=args.checkpoint_every,
+            resume=args.resume, surrogate_cache_mb=args.surrogate_cache_mb,
+            kn_interp_step=args.kn_interp_step, model_memory_mb=args.model_memory_mb)
     #        burn_in_length, burn_in_start, beta_start, keep_npts, nprocs)
     s.generate_samples()
 
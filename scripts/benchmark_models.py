@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark models
+----------------
+Time set_params() and evaluate() for a model, using parameters drawn from the
+priors. Useful for checking the effect of changes to the models on the cost
+of a likelihood evaluation.
+'''
+
+from __future__ import print_function
+import numpy as np
+import argparse
+import time
+
+from em_pe.models import model_dict, param_dict
+
+parser = argparse.ArgumentParser(description='Time model evaluations')
+parser.add_argument('--m', help='Name of model to use')
+parser.add_argument('--n', type=int, default=1000, help='Number of parameter samples per evaluation')
+parser.add_argument('--repeat', type=int, default=5, help='Number of times to repeat the evaluation')
+parser.add_argument('--tmin', type=float, default=0.5, help='Minimum time (in days)')
+parser.add_argument('--tmax', type=float, default=20.0, help='Maximum time (in days)')
+parser.add_argument('--n-times', type=int, default=15, help='Number of observation times per band')
+parser.add_argument('--fixed-param', action='append', nargs=2, help='Parameters with fixed values')
+args = parser.parse_args()
+
+model = model_dict[args.m]()
+fixed_params = {name:float(value) for [name, value] in args.fixed_param} if args.fixed_param is not None else {}
+t_bounds = [args.tmin, args.tmax]
+tdays = np.linspace(args.tmin, args.tmax, args.n_times)
+obs_times = {band:tdays for band in model.bands}
+model.set_obs_times(obs_times)
+
+### draw the parameters from their priors
+params = {}
+for name in model.param_names:
+    if name in fixed_params:
+        params[name] = fixed_params[name] * np.ones(args.n)
+    else:
+        params[name] = param_dict[name]().sample_from_prior(size=args.n)
+
+if model.vectorized:
+    print("Evaluating {} samples at once, {} times".format(args.n, args.repeat))
+else:
+    print("Evaluating {} samples one at a time, {} times".format(args.n, args.repeat))
+
+set_params_time = []
+evaluate_time = []
+for i in range(args.repeat):
+    if model.vectorized:
+        t1 = time.time()
+        model.set_params(params, t_bounds)
+        t2 = time.time()
+        model.evaluate_bands(obs_times)
+        t3 = time.time()
+        set_params_time.append(t2 - t1)
+        evaluate_time.append(t3 - t2)
+    else:
+        set_params_time.append(0.0)
+        evaluate_time.append(0.0)
+        for j in range(args.n):
+            t1 = time.time()
+            model.set_params({name:params[name][j] for name in params}, t_bounds)
+            t2 = time.time()
+            model.evaluate_bands(obs_times)
+            t3 = time.time()
+            set_params_time[-1] += t2 - t1
+            evaluate_time[-1] += t3 - t2
+
+set_params_time = np.array(set_params_time)
+evaluate_time = np.array(evaluate_time)
+print("set_params: {:.3f} ms (min {:.3f} ms)".format(1.0e3 * np.mean(set_params_time), 1.0e3 * np.min(set_params_time)))
+print("evaluate ({} bands): {:.3f} ms (min {:.3f} ms)".format(len(model.bands), 1.0e3 * np.mean(evaluate_time), 1.0e3 * np.min(evaluate_time)))
+print("per sample: {:.2f} us".format(1.0e6 * np.mean(set_params_time + evaluate_time) / args.n))
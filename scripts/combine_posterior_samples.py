@@ -3,10 +3,26 @@
 import numpy as np
 import argparse
 import sys
+import os
+import importlib.util
+
+def _load_sample_file():
+    ### load sample_file.py on its own: importing it through the em_pe package would run em_pe/__init__.py,
+    ### which imports the whole inference stack (astropy, lal, RIFT) that this script doesn't need
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "em_pe", "sample_file.py")
+    spec = importlib.util.spec_from_file_location("_em_pe_sample_file", fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+_sample_file = _load_sample_file()
+read_samples = _sample_file.read_samples
+write_samples = _sample_file.write_samples
 
 parser = argparse.ArgumentParser(description='Combine multiple posterior sample files into a single file.')
 parser.add_argument('--input-file', nargs="*", help='Input posterior sample file (can provide multiple instances)')
-parser.add_argument('--output-fname', default='samples-combined.txt', help='Filename for output')
+parser.add_argument('--output-fname', default='samples-combined.txt', help='Filename for output (in binary format if the name ends in .bin, otherwise as text)')
+parser.add_argument('--float32', action='store_true', help='Store samples as 32-bit floats (binary output only)')
 parser.add_argument('--keep-npts', type=int, help='Store the n highest-likelihood samples')
 parser.add_argument('--tempering-exp', default=1.0, type=float, help="Exponent for likelihoods")
 parser.add_argument('--max-lnL', default=np.inf, type=float, help="Maximum log-likelihood")
@@ -23,16 +39,15 @@ if args.input_file is None:
     sys.exit()
 
 out = []
+columns = None
 for fname in args.input_file:
     print("Loading samples from {}...".format(fname))
-    out.append(np.loadtxt(fname))
+    ### read the columns in the same order as the first file's (text or binary)
+    samples, columns = read_samples(fname, columns)
+    out.append(samples)
 
 out = np.concatenate(out, axis=0)
 
-with open(args.input_file[0], "r") as f:
-    header = f.readline()[2:] # read the header, remove the "# " at the beginning
-    header = header[:-1] # remove the '\n' at the end
-
 out = out[out[:,0] < args.max_lnL]
 out[:,0] *= args.tempering_exp
 
@@ -41,12 +56,11 @@ if args.keep_npts is not None:
     out = out[ind_sorted[out.shape[0] - args.keep_npts:]]
 
 if limits is not None:
-    params = header.split(" ")
-    for i, p in enumerate(params):
+    for i, p in enumerate(columns):
         if p in limits.keys():
             llim, rlim = limits[p]
             out = out[out[:,i] > llim]
             out = out[out[:,i] < rlim]
 
 
-np.savetxt(args.output_fname, out, header=header)
+write_samples(args.output_fname, out, columns, metadata={"input_files":args.input_file}, float32=args.float32)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Pack surrogates
+---------------
+Pack the Gaussian process surrogates used by the kn_interp_angle model (one
+directory per angle and time step, each with a JSON file and three text files)
+into a single binary archive. When the archive is present, the model
+memory-maps it instead of reading the individual files.
+'''
+
+from __future__ import print_function
+import numpy as np
+import argparse
+import os
+import hashlib
+
+from em_pe.models.kn_interp_angle import _load_gp, _gp_data
+from em_pe.models.surrogate import write_surrogate_archive, surrogate_archive
+
+parser = argparse.ArgumentParser(description='Pack the kn_interp_angle surrogates into a single binary archive')
+parser.add_argument('--dir', help='Directory containing the surrogates (default: $INTERP_LOC/surrogate_data/2021_Wollaeger_TorusPeanut/)')
+parser.add_argument('--out', help='Archive to write (default: surrogates.bin in the surrogate directory, which is where the model looks for it)')
+parser.add_argument('--no-cholesky', action='store_true', help="Don't store the Cholesky factors of the training kernel matrices (they're then computed when each surrogate is first used)")
+args = parser.parse_args()
+
+if args.dir is not None:
+    surrogate_dir = args.dir
+else:
+    surrogate_dir = os.path.join(os.environ["INTERP_LOC"], "surrogate_data/2021_Wollaeger_TorusPeanut/")
+surrogate_dir = os.path.abspath(surrogate_dir)
+out = args.out if args.out is not None else os.path.join(surrogate_dir, "surrogates.bin")
+
+### find all the surrogates, named (like the model does) by their path without the ".json" extension
+names = []
+for root, dirs, files in os.walk(surrogate_dir):
+    dirs.sort()
+    for fname in sorted(files):
+        if fname.endswith(".json"):
+            names.append(os.path.relpath(os.path.join(root, fname[:-5]), surrogate_dir))
+
+print("packing {} surrogates from {}".format(len(names), surrogate_dir))
+checksums = {} # checksums of every array written, to check the archive afterwards
+
+def _surrogates():
+    ### load the surrogates one at a time, so each one's arrays are written to the archive (and released)
+    ### before the next one is loaded
+    for i, name in enumerate(names):
+        if i == 0 or (i + 1) % 100 == 0:
+            print("  loading surrogate {} of {}".format(i + 1, len(names)))
+        data = _gp_data(_load_gp(os.path.join(surrogate_dir, name), variance=not args.no_cholesky))
+        checksums[name] = {key:hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+                           for key, value in data.items() if isinstance(value, np.ndarray)}
+        yield name, data
+
+write_surrogate_archive(out, _surrogates())
+print("wrote {} ({:.1f} MB)".format(out, os.path.getsize(out) / 1024.0**2))
+
+### check that everything can be read back
+archive = surrogate_archive(out)
+for name in names:
+    data = archive.get(name)
+    for key, checksum in checksums[name].items():
+        assert hashlib.sha1(np.ascontiguousarray(data[key]).tobytes()).hexdigest() == checksum, (name, key)
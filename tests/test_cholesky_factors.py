@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for the Cholesky factors that kn_interp_angle saves next to its
+surrogates.
+'''
+import os
+import sys
+import numpy as np
+import pytest
+
+### import the models the way the sampler does when run as a script, so the
+### em_pe package (and the inference-only packages it imports) isn't needed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "em_pe"))
+pytest.importorskip("sklearn")
+pytest.importorskip("joblib")
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import RBF, WhiteKernel, ConstantKernel as C
+from scipy.linalg import cholesky
+_load_cholesky = pytest.importorskip("models.kn_interp_angle", exc_type=ImportError)._load_cholesky
+
+def _gp(seed, n=20):
+    rng = np.random.default_rng(seed)
+    gp = GaussianProcessRegressor(kernel=WhiteKernel(1e-3) + C(1.0) * RBF(length_scale=[0.5, 0.5]))
+    gp.kernel_ = gp.kernel
+    gp.X_train_ = rng.uniform(size=(n, 2))
+    return gp
+
+def _expected(gp):
+    K = gp.kernel_(gp.X_train_)
+    K[np.diag_indices_from(K)] += gp.alpha
+    return cholesky(K, lower=True)
+
+@pytest.fixture
+def save_factors(monkeypatch):
+    monkeypatch.setenv("EM_PE_SURROGATE_SAVE_FACTORS", "1")
+
+def test_saved_factor_is_reused(tmp_path, save_factors):
+    gp = _gp(0)
+    fname_base = str(tmp_path / "model")
+    L = _load_cholesky(gp, fname_base)
+    assert os.path.isfile(fname_base + "_L.npz")
+    assert np.array_equal(_load_cholesky(gp, fname_base), L)
+    assert [f for f in os.listdir(str(tmp_path)) if f.endswith(".tmp")] == []
+
+def test_retrained_surrogate_gets_a_new_factor(tmp_path, save_factors):
+    fname_base = str(tmp_path / "model")
+    _load_cholesky(_gp(0), fname_base)
+    ### same number of training points, different inputs
+    gp = _gp(1)
+    assert np.allclose(_load_cholesky(gp, fname_base), _expected(gp))
+    ### same inputs, different hyperparameters
+    gp.kernel_ = WhiteKernel(1e-3) + C(2.0) * RBF(length_scale=[0.5, 0.5])
+    assert np.allclose(_load_cholesky(gp, fname_base), _expected(gp))
+
+@pytest.mark.parametrize("contents", [b"", b"PK\x03\x04 truncated", b"not a numpy file"])
+def test_unreadable_factor_is_recomputed(tmp_path, contents):
+    gp = _gp(0)
+    fname_base = str(tmp_path / "model")
+    with open(fname_base + "_L.npz", "wb") as f:
+        f.write(contents)
+    assert np.allclose(_load_cholesky(gp, fname_base), _expected(gp))
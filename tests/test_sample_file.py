@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for the posterior sample file tools, which must work without the
+packages only needed for inference (astropy, lal, RIFT).
+'''
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+### run a snippet in a fresh interpreter in which the inference-only packages can't be imported
+_BLOCKER = '''
+import sys
+class _blocker:
+    blocked = ("astropy", "lal", "lalsimulation", "RIFT")
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in self.blocked:
+            raise ImportError("blocked for the test: " + name)
+        return None
+sys.meta_path.insert(0, _blocker())
+'''
+
+def _run_without_inference_stack(code, tmp_path):
+    return subprocess.run([sys.executable, "-c", _BLOCKER + code], cwd=str(tmp_path),
+                          capture_output=True, text=True)
+
+def test_combine_posterior_samples_without_inference_stack(tmp_path):
+    columns = ["lnL", "p", "p_s", "mej", "vej"]
+    rng = np.random.default_rng(0)
+    samples = [rng.uniform(size=(10, 5)), rng.uniform(size=(7, 5))]
+    for i, s in enumerate(samples):
+        np.savetxt(str(tmp_path / "in{}.txt".format(i)), s, header=" ".join(columns))
+    script = os.path.join(REPO, "scripts", "combine_posterior_samples.py")
+    result = _run_without_inference_stack('''
+import runpy
+sys.argv = ["combine_posterior_samples.py", "--input-file", "in0.txt", "in1.txt", "--output-fname", "out.bin"]
+runpy.run_path({!r}, run_name="__main__")
+'''.format(script), tmp_path)
+    assert result.returncode == 0, result.stderr
+    result = _run_without_inference_stack('''
+import importlib.util
+spec = importlib.util.spec_from_file_location("sample_file", {!r})
+sample_file = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sample_file)
+samples, columns = sample_file.read_samples("out.bin")
+print(samples.shape, " ".join(columns))
+'''.format(os.path.join(REPO, "em_pe", "sample_file.py")), tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ["(17,", "5)"] + columns
+
+def test_plot_corner_imports_without_inference_stack(tmp_path):
+    pytest.importorskip("corner")
+    pytest.importorskip("matplotlib")
+    script = os.path.join(REPO, "em_pe", "plot_utils", "plot_corner.py")
+    result = _run_without_inference_stack('''
+import runpy
+module = runpy.run_path({!r}, run_name="plot_corner")
+assert callable(module["read_samples"])
+'''.format(script), tmp_path)
+    assert result.returncode == 0, result.stderr
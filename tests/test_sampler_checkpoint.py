@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for checkpointing and resuming the sampler.
+'''
+import os
+import sys
+import subprocess
+import importlib.util
+import numpy as np
+import pytest
+
+EM_PE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "em_pe")
+
+### the sampler is run as a script (as in the generated sample.sh scripts), which needs RIFT and the models
+sys.path.insert(0, EM_PE)
+pytest.importorskip("RIFT.integrators.MonteCarloEnsemble", exc_type=ImportError)
+pytest.importorskip("models", exc_type=ImportError)
+
+_spec = importlib.util.spec_from_file_location("sample_file", os.path.join(EM_PE, "sample_file.py"))
+sample_file = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sample_file)
+
+### runs the sampler, with writing the intermediate samples slowed down (so a write still in progress when the
+### process is killed would be caught), and kills it (without any cleanup) right after the n-th checkpoint
+_RUN = '''
+import sys, os, time
+sys.path.insert(0, {em_pe!r})
+import numpy as np
+np.random.seed(0)
+import sampler
+kill_at = int(os.environ.get("KILL_AT_CHECKPOINT", "0"))
+_write_samples = sampler.write_samples
+def slow_write_samples(f, *args, **kwargs):
+    if "_intermediate" in getattr(f, "name", ""):
+        time.sleep(2.0)
+    return _write_samples(f, *args, **kwargs)
+sampler.write_samples = slow_write_samples
+n_saved = [0]
+_save_checkpoint = sampler.sampler._save_checkpoint
+def save_checkpoint_and_kill(self):
+    _save_checkpoint(self)
+    n_saved[0] += 1
+    if n_saved[0] == kill_at:
+        os._exit(1)
+sampler.sampler._save_checkpoint = save_checkpoint_and_kill
+sys.argv = ["sampler.py"] + sys.argv[1:]
+sampler.main()
+'''
+
+def _run_sampler(tmp_path, args, kill_at=0):
+    env = dict(os.environ, KILL_AT_CHECKPOINT=str(kill_at))
+    cmd = [sys.executable, "-c", _RUN.format(em_pe=EM_PE), "--dat", str(tmp_path) + "/", "--m", "kilonova",
+           "--f", "g.txt", "--f", "r.txt", "--out", str(tmp_path / "samples.txt"), "--fixed-param", "dist", "40.0",
+           "--fixed-param", "kappa", "1.0", "--min", "4", "--max", "4", "--epoch", "2"] + args
+    return subprocess.run(cmd, cwd=str(tmp_path), capture_output=True, text=True, env=env)
+
+def _check_intermediate(tmp_path, i):
+    samples, columns = sample_file.read_samples(str(tmp_path / "samples_intermediate{}.txt".format(i)))
+    assert columns[:3] == ["lnL", "p", "p_s"]
+    assert samples.shape[0] > 0 and samples.shape[1] == len(columns)
+
+def test_killed_run_leaves_complete_intermediate_files(tmp_path):
+    t = np.linspace(1.0, 10.0, 8)
+    for band, m0 in [("g", 20.0), ("r", 19.5)]:
+        np.savetxt(str(tmp_path / (band + ".txt")), np.column_stack([t, np.zeros_like(t), m0 + 0.2 * t, 0.1 * np.ones_like(t)]))
+    ### the second checkpoint is saved after iteration 2, which started by queueing _intermediate1
+    result = _run_sampler(tmp_path, ["--checkpoint-every", "1"], kill_at=2)
+    assert result.returncode == 1, result.stderr
+    assert os.path.isfile(str(tmp_path / "samples_checkpoint.pkl"))
+    _check_intermediate(tmp_path, 1)
+    ### the resumed run writes the rest, and removes the checkpoint when it's done
+    result = _run_sampler(tmp_path, ["--checkpoint-every", "1", "--resume"])
+    assert result.returncode == 0, result.stderr
+    for i in range(1, 4):
+        _check_intermediate(tmp_path, i)
+    assert not os.path.exists(str(tmp_path / "samples_checkpoint.pkl"))
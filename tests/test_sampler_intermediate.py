@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for the intermediate sample files the sampler writes after each
+iteration.
+'''
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "em_pe"))
+pytest.importorskip("RIFT.integrators.MonteCarloEnsemble", exc_type=ImportError)
+pytest.importorskip("models", exc_type=ImportError)
+import sampler
+from sample_file import read_samples
+
+def test_keep_npts_intermediate_files_hold_best_samples(tmp_path):
+    t = np.linspace(1.0, 10.0, 8)
+    for band, m0 in [("g", 20.0), ("r", 19.5)]:
+        np.savetxt(str(tmp_path / (band + ".txt")), np.column_stack([t, np.zeros_like(t), m0 + 0.2 * t, 0.1 * np.ones_like(t)]))
+    np.random.seed(0)
+    out = str(tmp_path / "samples.txt")
+    s = sampler.sampler(str(tmp_path) + "/", "kilonova", ["g.txt", "r.txt"], out, v=False, min_iter=3, max_iter=3,
+                        fixed_params=[["dist", 40.0], ["kappa", 1.0]], estimate_dist=False, keep_npts=20)
+    s.generate_samples()
+    ### each file holds the 20 highest-lnL samples so far (in increasing order), so each one's
+    ### values can only be improved on by the next
+    lnL = [read_samples(str(tmp_path / "samples_intermediate{}.txt".format(i)))[0][:,0] for i in (1, 2)]
+    lnL.append(np.sort(read_samples(out)[0][:,0]))
+    for i, values in enumerate(lnL):
+        assert values.size == 20
+        assert np.all(np.diff(values) >= 0)
+        if i > 0:
+            assert np.all(values >= lnL[i - 1])
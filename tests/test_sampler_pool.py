@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for shutting down the sampler's likelihood worker pool when the
+likelihood is evaluated outside generate_samples.
+'''
+import os
+import sys
+import gc
+import multiprocessing
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "em_pe"))
+pytest.importorskip("RIFT.integrators.MonteCarloEnsemble", exc_type=ImportError)
+pytest.importorskip("models", exc_type=ImportError)
+import sampler
+
+@pytest.fixture
+def data_dir(tmp_path):
+    t = np.linspace(1.0, 10.0, 8)
+    for band, m0 in [("g", 20.0), ("r", 19.5)]:
+        np.savetxt(str(tmp_path / (band + ".txt")), np.column_stack([t, np.zeros_like(t), m0 + 0.2 * t, 0.1 * np.ones_like(t)]))
+    return str(tmp_path) + "/"
+
+def _sampler(data_dir):
+    return sampler.sampler(data_dir, "kilonova", ["g.txt", "r.txt"], data_dir + "samples.txt", v=False,
+                           fixed_params=[["dist", 40.0], ["kappa", 1.0]], estimate_dist=False, nprocs=2)
+
+def _log_likelihood(s):
+    rng = np.random.default_rng(0)
+    samples = {p:rng.uniform(*s.bounds[i], size=10) for i, p in enumerate(s.ordered_params)}
+    lnL = s.log_likelihood(samples, vect=True)
+    assert lnL.shape == (10, 1)
+    assert len(multiprocessing.active_children()) == 2
+
+def test_context_manager_shuts_down_pool(data_dir):
+    with _sampler(data_dir) as s:
+        _log_likelihood(s)
+    assert s.pool is None
+    assert multiprocessing.active_children() == []
+
+def test_unused_sampler_shuts_down_pool(data_dir):
+    s = _sampler(data_dir)
+    _log_likelihood(s)
+    del s
+    gc.collect()
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for the Gaussian process utilities in em_pe/models/surrogate.py.
+'''
+import os
+import importlib.util
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import RBF, Matern, WhiteKernel, ConstantKernel as C
+from scipy.linalg import cholesky
+
+### surrogate.py has no package-relative imports, so load it on its own rather than through em_pe.models
+_spec = importlib.util.spec_from_file_location("surrogate", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               os.pardir, "em_pe", "models", "surrogate.py"))
+surrogate = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(surrogate)
+
+def _gp(X, kernel, seed):
+    ### a "fitted" GP with the given design and random weights
+    gp = GaussianProcessRegressor(kernel=kernel, alpha=1e-6)
+    gp.kernel_ = kernel
+    gp.X_train_ = X
+    gp.alpha_ = np.random.default_rng(seed).normal(size=X.shape[0])
+    K = kernel(X)
+    K[np.diag_indices_from(K)] += gp.alpha
+    gp.L_ = cholesky(K, lower=True)
+    gp.design_ = surrogate.design_fingerprint(gp)
+    return gp
+
+def _kernel(length_scale=0.7, kind=RBF):
+    return WhiteKernel(1e-4) + C(1.5) * kind(length_scale=[length_scale] * 3)
+
+@pytest.fixture
+def X():
+    return np.random.default_rng(0).uniform(size=(30, 3))
+
+def test_shared_design_groups(X):
+    X_other = X.copy()
+    X_other[0,0] += 1e-3
+    gps = [_gp(X, _kernel(), 0), _gp(X_other, _kernel(), 1), _gp(X, _kernel(), 2),
+           _gp(X, _kernel(0.8), 3), _gp(X, _kernel(), 4)]
+    no_design = _gp(X, _kernel(), 5)
+    del no_design.design_
+    gps.append(no_design)
+    assert surrogate.shared_design_groups(gps) == [[0, 2, 4], [1], [3], [5]]
+
+@pytest.mark.parametrize("kind", [RBF, Matern])
+@pytest.mark.parametrize("return_std", [True, False])
+def test_stacked_weights_match_separate_predictions(X, kind, return_std):
+    gps = [_gp(X, _kernel(kind=kind), seed) for seed in range(4)]
+    inputs = np.random.default_rng(1).uniform(size=(12, 3))
+    values = np.array([0.1, 0.5, 0.9])
+    alpha = np.column_stack([gp.alpha_ for gp in gps])
+    mean, std = surrogate.gp_predict_columns(gps[0], inputs, 2, values, return_std=return_std, alpha=alpha)
+    assert mean.shape == (values.size, inputs.shape[0], len(gps))
+    for k, gp in enumerate(gps):
+        mean_k, std_k = surrogate.gp_predict_columns(gp, inputs, 2, values, return_std=return_std)
+        assert np.allclose(mean[:,:,k], mean_k, rtol=1e-12, atol=1e-12)
+        assert np.allclose(std, std_k, rtol=1e-12, atol=1e-12)
+    ### and against the full predictive covariance, one value at a time
+    for i, value in enumerate(values):
+        x = inputs.copy()
+        x[:,2] = value
+        K_trans = gps[0].kernel_(x, X)
+        assert np.allclose(mean[i], K_trans.dot(alpha), rtol=1e-10, atol=1e-10)
+        if return_std:
+            cov = gps[0].kernel_(x) - K_trans.dot(np.linalg.solve(gps[0].kernel_(X) + gps[0].alpha * np.eye(X.shape[0]), K_trans.T))
+            assert np.allclose(std[i], np.sqrt(np.diag(cov)), rtol=1e-6, atol=1e-8)
+
+def test_archive_written_from_a_generator(tmp_path):
+    rng = np.random.default_rng(2)
+    surrogates = {"a":{"X_train":rng.uniform(size=(7, 3)), "L":rng.uniform(size=(7, 7)), "alpha":0.1},
+                  "b/c":{"X_train":rng.uniform(size=(5, 3)).astype(np.float32), "empty":np.zeros(0), "kernel":"rbf"}}
+    released = []
+    def generate():
+        for name, data in surrogates.items():
+            yield name, data
+            ### the previous surrogate's arrays are on disk before the next one is asked for
+            released.append(name)
+    surrogate.write_surrogate_archive(str(tmp_path / "dict.bin"), surrogates)
+    surrogate.write_surrogate_archive(str(tmp_path / "generator.bin"), generate())
+    assert released == ["a", "b/c"]
+    assert sorted(os.listdir(str(tmp_path))) == ["dict.bin", "generator.bin"]
+    with open(str(tmp_path / "dict.bin"), "rb") as f1, open(str(tmp_path / "generator.bin"), "rb") as f2:
+        assert f1.read() == f2.read()
+    archive = surrogate.surrogate_archive(str(tmp_path / "generator.bin"))
+    for name, data in surrogates.items():
+        stored = archive.get(name)
+        for key, value in data.items():
+            if isinstance(value, np.ndarray):
+                assert stored[key].dtype == value.dtype and np.array_equal(stored[key], value)
+            else:
+                assert stored[key] == value